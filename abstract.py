@@ -47,6 +47,17 @@ class FileSystemInterface:
         It must also be hashable, and the hash of an object from here must equal the hash of the repr-object.
         """
 
+    def iter_file_list(self, batch_size=1000):
+        """
+        Yield the list of image file addresses in batches of at most 'batch_size'.
+        Together, the batches must be the same as get_file_list().
+
+        Implementations that find files gradually should override this to yield batches as soon as they are found.
+        """
+        files = self.get_file_list()
+        for i in range(0, len(files), batch_size):
+            yield files[i:i + batch_size]
+
     @abstractmethod
     def get_image(self, name) -> Optional[pygame.Surface]:
         """
@@ -54,6 +65,50 @@ class FileSystemInterface:
         The image is specified by the address object from get_file_list().
         """
 
+    def get_fingerprint(self, name) -> Optional[str]:
+        """
+        Return a string that identifies the content of the image, so that copies and moved files can be recognized.
+        It must be much cheaper than reading the image. None means the content cannot be identified.
+        """
+        return None
+
+    def get_stat(self, name) -> Optional[tuple]:
+        """
+        Return a cheap (mtime, size) pair of the image file, used to notice that it changed.
+        None means it is unknown, and the image is never considered changed.
+        """
+        return None
+
+    def fetch(self, name, size: (int, int)) -> Optional[bytes]:
+        """
+        Read what is needed of an image file to make a thumbnail that fits 'size', for decode_fetched().
+        That should be no more than the header if the image has a large enough embedded thumbnail.
+        This is where a slow source spends its time, so many fetches may run at once on different threads.
+        The default returns None, and leaves the reading to decode_fetched().
+        """
+        return None
+
+    def decode_fetched(self, name, data: Optional[bytes], size: (int, int)) -> (Optional[pygame.Surface],
+                                                                                Optional[tuple]):
+        """
+        Like get_image_for_thumbnail(), but from the bytes returned by fetch().
+        The default ignores them, and calls get_image_for_thumbnail().
+        """
+        return self.get_image_for_thumbnail(name, size)
+
+    def get_image_for_thumbnail(self, name, size: (int, int)) -> (Optional[pygame.Surface], Optional[tuple]):
+        """
+        Return an image to make a thumbnail that fits 'size' from, and the size of the original image.
+
+        The image may be smaller than the original, as long as it is at least as large as that thumbnail.
+        If the image cannot be read, return (None, None).
+        If it can, but is too large to decode, return None and its size; it gets a placeholder that is not stored.
+        """
+        image = self.get_image(name)
+        if image is None:
+            return None, None
+        return image, image.get_size()
+
 
 class GUIActivity:
     __metaclass__ = ABCMeta
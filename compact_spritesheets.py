@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+import logging
+import os
+import sys
+
+import spritesheet_manager
+
+# compact_spritesheets.py - Report how full the spritesheets are, and repack them.
+# Copyright (C) 2019 Danya Generalov (https://github.com/danya02)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+def print_report(report: dict):
+    print('Sheet   Size        Atlas      Thumbs  Fill  Fragmentation')
+    for i in report['sheets']:
+        print(f"{i['id']:<7} {i['width']}x{i['height']:<6} {i['atlas'] or '-':<10} {i['thumbnails']:>6} "
+              f"{i['fill']:>5.0%} {i['fragmentation']:>13.0%}")
+    print()
+    print('Scale       Thumbs  Sheets')
+    for name, i in sorted(report['scales'].items()):
+        print(f"{name:<11} {i['thumbnails']:>6} {i['sheets']:>7}")
+    print()
+    print('Group       Thumbs  Sheets  Needed')
+    for i in report['groups']:
+        print(f"{i['atlas'] or 'packed':<11} {i['thumbnails']:>6} {i['sheets']:>7} {i['sheets_needed']:>7}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if sys.argv[1:] not in ([], ['--run']):
+        print(f'Usage: {sys.argv[0]} [--run]')
+        exit(1)
+    raw = any(i.endswith('.raw') for i in os.listdir('spritesheets'))
+    manager = spritesheet_manager.SpritesheetManager('', None, sheet_format=spritesheet_manager.RAW if raw
+                                                     else spritesheet_manager.PNG)
+    print_report(manager.fragmentation_report())
+    if sys.argv[1:] == ['--run']:
+        print(f'\nFreed {manager.compact()} spritesheets.\n')
+        print_report(manager.fragmentation_report())
@@ -0,0 +1,29 @@
+#!/usr/bin/python3
+import logging
+import sys
+
+import spritesheet_manager
+
+# convert_spritesheets.py - Convert stored spritesheets between the PNG and RAW formats.
+# Copyright (C) 2019 Danya Generalov (https://github.com/danya02)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2 or sys.argv[1] not in (spritesheet_manager.RAW, spritesheet_manager.PNG):
+        print(f'Usage: {sys.argv[0]} raw|png [--keep]')
+        exit(1)
+    count = spritesheet_manager.convert_sheet_files(sys.argv[1], keep_old='--keep' in sys.argv[2:])
+    print(f'Converted {count} spritesheets.')
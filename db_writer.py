@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+import atexit
+import concurrent.futures
+import functools
+import logging
+import queue
+import threading
+import time
+
+l = logging.getLogger(__name__)
+
+# db_writer.py - Run the writes to a database on a single thread, in batched transactions.
+# Copyright (C) 2019 Danya Generalov (https://github.com/danya02)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+DEFAULT_BATCH_SIZE = 200
+DEFAULT_MAX_DELAY = 0.005
+
+
+class DatabaseWriter:
+    def __init__(self, database, batch_size=DEFAULT_BATCH_SIZE, max_delay=DEFAULT_MAX_DELAY):
+        """
+        Runs every write to one SQLite database on one thread, so writers never wait for each other's locks.
+
+        A write is a function, called on the writer thread inside a transaction.
+        Queued writes share a transaction, which is committed after 'batch_size' of them,
+        or 'max_delay' seconds after the first one. A write that a caller is waiting for with run()
+        does not wait for more writes to arrive; it is committed as soon as the queue is empty.
+        Every write has its own savepoint, so a failing write does not undo the others.
+        Results are only handed out once their transaction is committed.
+        """
+        self.database = database
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.writes = 0
+        atexit.register(self.close)
+
+    def submit(self, function, *args, **kwargs) -> concurrent.futures.Future:
+        """Queue a write and return a future of its result."""
+        return self.put(function, args, kwargs, False)
+
+    def run(self, function, *args, **kwargs):
+        """Do a write and return its result once it is committed. On the writer thread, it is simply called."""
+        if threading.current_thread() is self.thread:
+            return function(*args, **kwargs)
+        return self.put(function, args, kwargs, True).result()
+
+    def writing(self, function):
+        """Decorate a function so that every call of it is done with run()."""
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return self.run(function, *args, **kwargs)
+        return wrapper
+
+    def flush(self):
+        """Wait until every write queued so far is committed."""
+        self.run(lambda: None)
+
+    def close(self):
+        """Commit what is queued and stop the thread. It is started again by the next write."""
+        with self.lock:
+            thread = self.thread
+            if thread is None or not thread.is_alive():
+                return
+            self.queue.put(None)
+        thread.join()
+
+    def put(self, function, args, kwargs, urgent) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.loop, name='DatabaseWriter', daemon=True)
+                self.thread.start()
+            self.queue.put((future, function, args, kwargs, urgent))
+        return future
+
+    def loop(self):
+        stop = False
+        while not stop:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    if any(i[4] for i in batch):
+                        batch.append(self.queue.get_nowait())
+                    else:
+                        batch.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                batch.pop()
+                stop = True
+            if batch:
+                self.write_batch(batch)
+
+    def write_batch(self, batch):
+        results = []
+        try:
+            with self.database.atomic():
+                for future, function, args, kwargs, _ in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        with self.database.atomic():
+                            results.append((future, function(*args, **kwargs), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+        except Exception as e:
+            l.error('Could not commit %d writes: %s', len(results), e)
+            results = [(future, None, e) for future, _, _ in results]
+        self.batches += 1
+        self.writes += len(results)
+        for future, result, exception in results:
+            if exception is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exception)
+
+    def stats(self) -> dict:
+        return {'batches': self.batches, 'writes': self.writes, 'queued': self.queue.qsize()}
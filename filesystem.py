@@ -1,7 +1,12 @@
 #!/usr/bin/python3
+import hashlib
+import io
+import json
 import logging
 import os
 import random
+import struct
+import threading
 import time
 from typing import Optional
 
@@ -10,8 +15,19 @@ import pygame
 import abstract
 from legacy import color
 
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it, JPEGs are decoded at full resolution.
+    Image = None
+
 l = logging.getLogger(__name__)
 
+INDEX_VERSION = 1
+DEFAULT_MAX_DECODE_BYTES = 512 * 1024 * 1024
+FINGERPRINT_BLOCK = 64 * 1024
+FETCH_HEADER_BYTES = 256 * 1024  # enough for the EXIF segment and frame header of practically every JPEG
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
 
 # filesystem.py - Abstraction for the local filesystem.
 # Copyright (C) 2019 Danya Generalov (https://github.com/danya02)
@@ -30,29 +46,350 @@ l = logging.getLogger(__name__)
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
+def read_jpeg_header(file):
+    """
+    Read the segments of a JPEG file up to its frame header, skipping over everything else.
+    Returns the image width, height and the embedded EXIF thumbnail (or None), or None if this is not a JPEG.
+    """
+    if file.read(2) != b'\xff\xd8':
+        return None
+    thumbnail = None
+    while True:
+        marker = file.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return None
+        while marker[1] == 0xff:  # fill bytes
+            marker = marker[1:] + file.read(1)
+            if len(marker) < 2:
+                return None
+        kind = marker[1]
+        if kind == 0x01 or 0xd0 <= kind <= 0xd7:  # markers without a segment
+            continue
+        if kind in (0xd9, 0xda):  # end of image or start of scan before any frame header
+            return None
+        length = file.read(2)
+        if len(length) < 2:
+            return None
+        length = struct.unpack('>H', length)[0]
+        if 0xc0 <= kind <= 0xcf and kind not in (0xc4, 0xc8, 0xcc):
+            frame = file.read(5)
+            if len(frame) < 5:
+                return None
+            _, height, width = struct.unpack('>BHH', frame)
+            return width, height, thumbnail
+        if kind == 0xe1 and thumbnail is None:
+            segment = file.read(length - 2)
+            if segment.startswith(b'Exif\0\0'):
+                thumbnail = read_exif_thumbnail(segment[6:])
+        else:
+            file.seek(length - 2, io.SEEK_CUR)
+
+
+def open_source(name, data: bytes = None):
+    """Open an image file for reading, or its bytes if they were already fetched."""
+    return io.BytesIO(data) if data is not None else open(name, 'rb')
+
+
+pillow_limit_lock = threading.Lock()
+
+
+def open_unchecked(name, data: bytes = None):
+    """
+    Open an image with Pillow, skipping its decompression bomb check.
+    That check counts the pixels at full size, which draft() can cut by 64 for a JPEG,
+    so the callers check the drafted size against max_decode_bytes instead.
+    """
+    with pillow_limit_lock:
+        limit, Image.MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS, None
+        try:
+            return Image.open(open_source(name, data))
+        finally:
+            Image.MAX_IMAGE_PIXELS = limit
+
+
+def read_exif_thumbnail(tiff: bytes):
+    """Extract the JPEG thumbnail referenced by the second image file directory (IFD1) of EXIF data."""
+    try:
+        order = {b'II': '<', b'MM': '>'}[tiff[:2]]
+        ifd0 = struct.unpack_from(order + 'I', tiff, 4)[0]
+        entries = struct.unpack_from(order + 'H', tiff, ifd0)[0]
+        ifd1 = struct.unpack_from(order + 'I', tiff, ifd0 + 2 + 12 * entries)[0]
+        if ifd1 == 0:
+            return None
+        offset = length = None
+        for i in range(struct.unpack_from(order + 'H', tiff, ifd1)[0]):
+            tag, _, _, value = struct.unpack_from(order + 'HHII', tiff, ifd1 + 2 + 12 * i)
+            if tag == 0x0201:  # JPEGInterchangeFormat
+                offset = value
+            elif tag == 0x0202:  # JPEGInterchangeFormatLength
+                length = value
+    except (KeyError, struct.error):
+        return None
+    if offset is None or not length or offset + length > len(tiff):
+        return None
+    return tiff[offset:offset + length]
+
+
 class LocalFilesystem(abstract.FileSystemInterface):
-    def __init__(self, basepath, slowness=0):
+    def __init__(self, basepath, slowness=0, index_path=None, max_decode_bytes=DEFAULT_MAX_DECODE_BYTES):
         """
         An interface to the local file system.
 
         The hard disk is fast, unlike network interactions, so 'slowness' seconds will be delayed before every
         get_image return.
+
+        If 'index_path' is given, the directory tree is remembered in that file between runs,
+        and only directories whose modification time changed are listed again.
+
+        Images are never decoded for thumbnails if their pixels would take more than 'max_decode_bytes' of memory,
+        even after decoding at a reduced scale. Their thumbnail is a plain grey placeholder with their proportions,
+        which is not stored, so they are tried again every time their thumbnail is asked for.
         """
         super().__init__()
         self.base_path = basepath
         self.slowness = slowness
-        self.picture_endings = ['.png', '.jpg', '.jpeg']  # TODO: add more image extensions.
+        self.index_path = index_path
+        self.max_decode_bytes = max_decode_bytes
+        self.picture_endings = ('.png', '.jpg', '.jpeg')  # TODO: add more image extensions.
 
-    def get_file_list(self) -> [str]:
+    def load_index(self) -> dict:
+        if self.index_path is None:
+            return dict()
+        try:
+            with open(self.index_path) as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            l.info('Directory index at %s is missing or broken, scanning everything.', self.index_path)
+            return dict()
+        if index.get('version') != INDEX_VERSION or index.get('base') != self.base_path or \
+                index.get('endings') != list(self.picture_endings):
+            return dict()
+        return index['dirs']
+
+    def save_index(self, dirs: dict):
+        if self.index_path is None:
+            return
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump({'version': INDEX_VERSION, 'base': self.base_path, 'endings': list(self.picture_endings),
+                       'dirs': dirs}, file)
+        os.replace(temp_path, self.index_path)
+
+    def list_directory(self, path) -> ([str], [str]):
+        dirs = []
+        files = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if not entry.is_symlink():
+                            dirs.append(entry.name)
+                    elif entry.name.endswith(self.picture_endings):
+                        files.append(entry.name)
+        except OSError:
+            l.info('Could not list directory %s', path)
+        return sorted(dirs), sorted(files)
+
+    def scan(self):
+        """Yield image paths directory by directory. The index is saved once the scan is complete."""
         l.debug('File list get...')
-        outp = []
-        for i in os.walk(self.base_path):
-            for j in i[2]:
-                path = i[0] + os.path.sep + j
-                for e in self.picture_endings:
-                    if path.endswith(e):
-                        outp += [path]
-        return outp
+        old_index = self.load_index()
+        new_index = dict()
+        relisted = 0
+        # A directory changed within this window may change again without its mtime moving, so it is not trusted.
+        racy_after = time.time_ns() - 2 * 10 ** 9
+        stack = [self.base_path]
+        while stack:
+            path = stack.pop()
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entry = old_index.get(path)
+            if entry is not None and entry['mtime'] == stat.st_mtime_ns and entry['inode'] == stat.st_ino:
+                dirs, files = entry['dirs'], entry['files']
+            else:
+                relisted += 1
+                dirs, files = self.list_directory(path)
+            new_index[path] = {'mtime': stat.st_mtime_ns if stat.st_mtime_ns < racy_after else None,
+                               'inode': stat.st_ino, 'dirs': dirs, 'files': files}
+            # Same form of path as the old os.walk scan produced, so names already in the databases stay valid.
+            for i in files:
+                yield path + os.path.sep + i
+            stack.extend(os.path.join(path, i) for i in reversed(dirs))
+        l.debug('Listed %d of %d directories.', relisted, len(new_index))
+        if relisted or len(new_index) != len(old_index):
+            self.save_index(new_index)
+
+    def get_file_list(self) -> [str]:
+        return list(self.scan())
+
+    def iter_file_list(self, batch_size=1000, max_delay=0.5):
+        """
+        Yield the file list in batches while the scan is still running.
+
+        A batch is yielded when it has 'batch_size' paths, or 'max_delay' seconds after the previous one,
+        so a slow tree still shows its first images quickly.
+        """
+        batch = []
+        last_yield = time.monotonic()
+        for path in self.scan():
+            batch.append(path)
+            if len(batch) >= batch_size or time.monotonic() - last_yield >= max_delay:
+                yield batch
+                batch = []
+                last_yield = time.monotonic()
+        if batch:
+            yield batch
+
+    def get_fingerprint(self, name):
+        """The file size and a hash of a few blocks sampled from the start, middle and end of the file."""
+        try:
+            with open(name, 'rb') as file:
+                size = os.fstat(file.fileno()).st_size
+                digest = hashlib.blake2b(digest_size=16)
+                for offset in sorted({0, max(0, size // 2 - FINGERPRINT_BLOCK // 2), max(0, size - FINGERPRINT_BLOCK)}):
+                    file.seek(offset)
+                    digest.update(file.read(FINGERPRINT_BLOCK))
+        except OSError:
+            return None
+        return f'{size}:{digest.hexdigest()}'
+
+    def get_stat(self, name):
+        try:
+            stat = os.stat(name)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def get_embedded_thumbnail(self, name, size: (int, int), data: bytes = None):
+        """
+        Get the thumbnail a camera embedded in a JPEG file, reading only the start of the file.
+        Returns it with the size of the full image, or None if there is none that is large enough for 'size'.
+        """
+        if not name.lower().endswith(('.jpg', '.jpeg')):
+            return None
+        try:
+            with open_source(name, data) as file:
+                header = read_jpeg_header(file)
+        except OSError:
+            return None
+        if header is None or header[2] is None:
+            return None
+        width, height, data = header
+        try:
+            thumbnail = pygame.image.load(io.BytesIO(data), 'thumbnail.jpg')
+        except pygame.error:
+            return None
+        target = pygame.Rect(0, 0, width, height).fit(pygame.Rect((0, 0), size))
+        # Thumbnails of another shape than the image are letterboxed, and would show black bars.
+        same_shape = abs(thumbnail.get_width() * height - thumbnail.get_height() * width) <= \
+                     0.02 * thumbnail.get_width() * height
+        if not same_shape or thumbnail.get_width() < target.width or thumbnail.get_height() < target.height:
+            return None
+        return thumbnail, (width, height)
+
+    def get_image_for_thumbnail(self, name, size: (int, int), data: bytes = None):
+        """'data' is the content of the file, if it was already read by fetch()."""
+        embedded = self.get_embedded_thumbnail(name, size, data)
+        if embedded is not None:
+            l.debug('Using the embedded thumbnail of %s.', name)
+            if data is None:
+                time.sleep(self.slowness)
+            return embedded
+        return self.decode_reduced(name, size, data)
+
+    def fetch(self, name, size: (int, int)):
+        """
+        Read the header of the file first. If it has an embedded thumbnail that is large enough,
+        or the image is too large to decode, the rest of the file is not read.
+        """
+        time.sleep(self.slowness)
+        try:
+            with open(name, 'rb') as file:
+                header = file.read(FETCH_HEADER_BYTES)
+                if len(header) < FETCH_HEADER_BYTES:  # that was the whole file
+                    return header
+                if self.get_embedded_thumbnail(name, size, header) is not None:
+                    return header
+                decoded_size = self.decoded_size(name, size, header)
+                if decoded_size is not None and decoded_size[0] * decoded_size[1] * 4 > self.max_decode_bytes:
+                    return header
+                return header + file.read()
+        except OSError:
+            return None
+
+    def decode_fetched(self, name, data, size: (int, int)):
+        if data is None:
+            return None, None
+        return self.get_image_for_thumbnail(name, size, data)
+
+    def decoded_size(self, name, size: (int, int), data: bytes = None):
+        """The size decode_reduced() would decode an image at, from its header alone, or None if that is unknown."""
+        if Image is None:
+            return self.probe_size(name, data)
+        try:
+            with open_unchecked(name, data) as image:
+                image.draft('RGB', pygame.Rect((0, 0), image.size).fit(pygame.Rect((0, 0), size)).size)
+                return image.size
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def probe_size(name, data: bytes = None):
+        """Read the pixel size of a PNG or JPEG from its header, without decoding it. Returns None if unknown."""
+        try:
+            with open_source(name, data) as file:
+                head = file.read(24)
+                if head[:8] == PNG_SIGNATURE and head[12:16] == b'IHDR':
+                    return struct.unpack('>II', head[16:24])
+                file.seek(0)
+                header = read_jpeg_header(file)
+        except OSError:
+            return None
+        return None if header is None else header[:2]
+
+    def decode_reduced(self, name, size: (int, int), data: bytes = None):
+        """
+        Decode an image for a thumbnail that fits 'size', with as little memory as the codec allows.
+
+        If Pillow is installed, JPEGs are decoded at the smallest DCT scale that is still large enough.
+        Images whose decoded pixels would go over max_decode_bytes are not decoded; for them, only the image is None.
+        Returns the image and the original size, or (None, None).
+        """
+        if data is None:
+            time.sleep(self.slowness)
+        if Image is not None:
+            try:
+                with open_unchecked(name, data) as image:
+                    original_size = image.size
+                    target = pygame.Rect((0, 0), original_size).fit(pygame.Rect((0, 0), size)).size
+                    image.draft('RGB', target)
+                    if image.width * image.height * 4 > self.max_decode_bytes:
+                        return self.too_large(name, original_size, image.size)
+                    image.thumbnail(target)
+                    image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+                    return pygame.image.fromstring(image.tobytes(), image.size, image.mode), original_size
+            except (OSError, ValueError):
+                l.debug('Pillow could not decode %s, trying pygame.', name)
+        original_size = self.probe_size(name, data)
+        if original_size is not None and original_size[0] * original_size[1] * 4 > self.max_decode_bytes:
+            return self.too_large(name, original_size, original_size)
+        l.debug('Getting image at file %s...', name)
+        try:
+            image = pygame.image.load(open_source(name, data), name)
+        except (pygame.error, OSError):
+            return None, None
+        return image, image.get_size()
+
+    @staticmethod
+    def too_large(name, original_size: (int, int), decoded_size: (int, int)):
+        l.info('Not decoding %s: %dx%d pixels is over the memory limit.', name, *decoded_size)
+        return None, tuple(original_size)
 
     def get_image(self, name, for_thumbnail=False) -> Optional[pygame.Surface]:
         time.sleep(self.slowness)
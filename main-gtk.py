@@ -6,6 +6,7 @@ import gi
 import abstract
 import filesystem
 import spritesheet_manager
+import thumbnail_pipeline
 
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk as gtk, Gdk as gdk, GLib, GObject as gobject, GdkPixbuf
@@ -15,6 +16,7 @@ import time
 import os
 import threading
 import collections
+import itertools
 import tags
 
 import logging
@@ -23,35 +25,147 @@ l = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-def surface_to_pixbuf(surface):
-    filename = f'/tmp/thumbnailer_pixbuf_convert/{str(uuid.uuid4())}.png'
-    try:
-        os.makedirs('/tmp/thumbnailer_pixbuf_convert/')
-    except FileExistsError:
-        pass
-    pygame.image.save(surface, filename)
-    #        data = pygame.image.tostring(img, 'RGB')
-    #        pixbuf = GdkPixbuf.Pixbuf.new_from_data(data, GdkPixbuf.Colorspace.RGB, False, 8, img.get_width(), img.get_height(), img.get_width()*3)
-    pixbuf = GdkPixbuf.Pixbuf.new_from_file(filename)
-    return pixbuf
+def surface_to_pixbuf(surface: pygame.Surface) -> GdkPixbuf.Pixbuf:
+    """Build a pixbuf straight from the surface's pixels, without an intermediate image file."""
+    has_alpha = bool(surface.get_flags() & pygame.SRCALPHA)
+    mode = 'RGBA' if has_alpha else 'RGB'
+    width, height = surface.get_size()
+    data = GLib.Bytes.new(pygame.image.tostring(surface, mode))
+    return GdkPixbuf.Pixbuf.new_from_bytes(data, GdkPixbuf.Colorspace.RGB, has_alpha, 8, width, height,
+                                           width * len(mode))
+
+
+def surfaces_to_pixbufs(surfaces: [pygame.Surface]) -> [GdkPixbuf.Pixbuf]:
+    """
+    Convert many surfaces with a single pixbuf conversion.
+
+    The surfaces are blitted into one strip, and only the strip is converted to a pixbuf;
+    every result is a sub-pixbuf view of it, which keeps the whole strip alive.
+    """
+    if not surfaces:
+        return []
+    has_alpha = any(i.get_flags() & pygame.SRCALPHA for i in surfaces)
+    strip = pygame.Surface((max(i.get_width() for i in surfaces), sum(i.get_height() for i in surfaces)),
+                           pygame.SRCALPHA if has_alpha else 0)
+    areas = []
+    top = 0
+    for i in surfaces:
+        strip.blit(i, (0, top))
+        areas.append((top, i.get_width(), i.get_height()))
+        top += i.get_height()
+    pixbuf = surface_to_pixbuf(strip)
+    return [pixbuf.new_subpixbuf(0, top, width, height) for top, width, height in areas]
 
 
 class PixbufLoader(metaclass=abstract.Singleton):
-    def __init__(self, fs):
+    def __init__(self, fs, max_sheets=8, pipeline=False):
+        """
+        Makes pixbufs of thumbnails for the icon view.
+
+        A stored thumbnail is a sub-pixbuf view into a pixbuf of its whole spritesheet, so a page takes
+        one conversion per sheet instead of one per thumbnail. A sheet is converted again after its pixels change.
+        Every view keeps its sheet pixbuf alive, so the memory taken is one sheet pixbuf for every version of a sheet
+        that has a thumbnail in the models. 'max_sheets' only bounds the pixbufs kept for sheets that are not shown.
+        Thumbnails in sheets with unsaved changes, which are still being filled, are copied instead,
+        so that a sheet does not leave a pixbuf behind for each thumbnail added to it;
+        get_many() converts those copies together, with surfaces_to_pixbufs().
+        If 'pipeline' is True, missing thumbnails are made by a ThumbnailPipeline, which reads many files at once,
+        instead of by the process pool of the SpritesheetManager.
+        """
         self.fs = fs
-        self.spritesheet_manager = spritesheet_manager.SpritesheetManager('', fs)
-        self.cache = {}
+        self.pipeline = pipeline
+        self.spritesheet_manager = spritesheet_manager.SpritesheetManager('', fs, atlas=True, location_index=True)
+        self.sheets = collections.OrderedDict()
+        self.max_sheets = max_sheets
         self.maxsize = (100, 100)
+        self.lock = threading.RLock()
 
     def clear_cache(self):
-        self.cache.clear()
+        self.sheets.clear()
         self.spritesheet_manager.clear_cache()
 
+    def sheet_pixbuf(self, sheet_id) -> GdkPixbuf.Pixbuf:
+        ssl = self.spritesheet_manager.ssl
+        with ssl.lock:
+            version = ssl.version(sheet_id)
+            if sheet_id in self.sheets and self.sheets[sheet_id][0] == version:
+                self.sheets.move_to_end(sheet_id)
+                return self.sheets[sheet_id][1]
+            pixbuf = surface_to_pixbuf(ssl[sheet_id])
+        self.sheets[sheet_id] = (version, pixbuf)
+        self.sheets.move_to_end(sheet_id)
+        while len(self.sheets) > self.max_sheets:
+            self.sheets.popitem(last=False)
+        return pixbuf
+
+    def cell_pixbuf(self, sheet_id, rect: pygame.Rect) -> GdkPixbuf.Pixbuf:
+        ssl = self.spritesheet_manager.ssl
+        with ssl.lock:
+            if str(sheet_id) in ssl.dirty:
+                return surface_to_pixbuf(ssl.get_area(sheet_id, rect))
+            return self.sheet_pixbuf(sheet_id).new_subpixbuf(rect.x, rect.y, rect.width, rect.height)
+
     def __getitem__(self, item):
-        if item in self.cache:
-            return self.cache[item]
-        self.cache[item] = value = surface_to_pixbuf(self.spritesheet_manager.get_thumbnail(item, self.maxsize))
-        return value
+        with self.lock:
+            scale = self.spritesheet_manager.get_scale(self.maxsize)
+            location = self.spritesheet_manager.lookup_many([item], scale).get(item)
+            if location is not None:
+                return self.cell_pixbuf(*location)
+            thumbnail = self.spritesheet_manager.get_thumbnail(item, self.maxsize, copy=False)
+            if thumbnail is None:
+                return None
+            return surface_to_pixbuf(thumbnail)
+
+    def get_many(self, items):
+        """
+        Yield (item, pixbuf) pairs as the thumbnails become ready. The pixbuf is None if it could not be made.
+        The loader is locked while each thumbnail is made, not while the caller holds the iterator.
+        """
+        items = list(items)
+        with self.lock:
+            scale = self.spritesheet_manager.get_scale(self.maxsize)
+            locations = self.spritesheet_manager.lookup_many(items, scale)
+        missing = []
+        copied = []
+        ssl = self.spritesheet_manager.ssl
+        for item in items:
+            if item not in locations:
+                missing.append(item)
+                continue
+            sheet_id, rect = locations[item]
+            with self.lock, ssl.lock:
+                if str(sheet_id) in ssl.dirty:
+                    copied.append((item, ssl.get_area(sheet_id, rect)))
+                    continue
+                pixbuf = self.sheet_pixbuf(sheet_id).new_subpixbuf(rect.x, rect.y, rect.width, rect.height)
+            yield item, pixbuf
+        if copied:
+            with self.lock:
+                pixbufs = surfaces_to_pixbufs([surface for _, surface in copied])
+            yield from zip([item for item, _ in copied], pixbufs)
+        # New thumbnails arrive one by one while their sheet keeps changing, so they are converted on their own.
+        if self.pipeline:
+            thumbnails = thumbnail_pipeline.iterate(self.spritesheet_manager, missing, self.maxsize, copy=False)
+        else:
+            thumbnails = self.spritesheet_manager.get_thumbnails(missing, self.maxsize, copy=False)
+        done = object()
+        try:
+            while True:
+                with self.lock:
+                    result = next(thumbnails, done)
+                    if result is done:
+                        return
+                    item, surface = result
+                    pixbuf = None if surface is None else surface_to_pixbuf(surface)
+                yield item, pixbuf
+        finally:
+            with self.lock:
+                thumbnails.close()
+
+    def refresh_stale(self, items) -> [object]:
+        """Make the thumbnails of files that changed again. Returns those files, whose pixbufs are now outdated."""
+        with self.lock:
+            return self.spritesheet_manager.refresh_stale(items)
 
 
 class MainAppGTK:
@@ -78,10 +192,18 @@ class MainAppGTK:
         self.builder.get_object('ImageTagMenuButton').connect('clicked', self.open_assign_tag_popover)
 
         self.tags_selected = tags.get_all_tags()
+        self.tags_mode = tags.ANY
 
         self.models = collections.defaultdict(lambda: gtk.ListStore(GdkPixbuf.Pixbuf, str))
         self.built_models = collections.defaultdict(lambda: False)
         self.len_models = 1
+        self.models_lock = threading.Condition(threading.RLock())
+        self.shown = []
+        self.shown_set = set()
+        self.page_rows = dict()
+        self.page_filled = collections.defaultdict(set)
+        self.models_generation = 0
+        self.prefetch_pages = 2
 
         self.builder.get_object('MainWindow').connect('destroy', self.shutdown)
         self.builder.get_object('ButtonPrev').connect('clicked', self.prev)
@@ -90,12 +212,12 @@ class MainAppGTK:
         self.builder.get_object('ClearCache').connect('clicked', self.purge_cache)
         self.page = 0
         self.items_on_page = 100
-        self.filesystem = filesystem.LocalFilesystem('/home/danya/Pictures/', 0.0)
-        self.pbloader = PixbufLoader(self.filesystem)
+        self.filesystem = filesystem.LocalFilesystem('/home/danya/Pictures/', 0.0, index_path='./filelist_index.json')
+        self.pbloader = PixbufLoader(self.filesystem, pipeline=True)
         self.file_list = None
+        self.unique_loader_value = ''
         self.load_file_list()
         self.informed_dbase_about_filelist = False
-        self.unique_loader_value = ''
         self.prev(None)
         self.status_message = 'Ready.'
         self.status_spinner = False
@@ -103,9 +225,12 @@ class MainAppGTK:
         self.selected_picture = ''
         self.image_assign_null_switch = None
         gobject.timeout_add(100, self.update_status_loop)
+        threading.Thread(target=self.fill_models, daemon=True).start()
         self.rebuild_models()
 
     def shutdown(self, arg):
+        self.pbloader.spritesheet_manager.close()
+        l.info('Spritesheet cache: %s', self.pbloader.spritesheet_manager.ssl.stats())
         try:
             os.unlink('/tmp/thumbnails')
         except:
@@ -121,18 +246,22 @@ class MainAppGTK:
         return response == gtk.ResponseType.OK
 
     def prev(self, widget):
-        self.page = max(0, self.page - 1)
-        print('page now', self.page)
-        self.iconview.set_model(self.models[self.page])
-        self.iconview.set_pixbuf_column(0)
-        self.iconview.set_text_column(-1)
+        with self.models_lock:
+            self.page = max(0, self.page - 1)
+            print('page now', self.page)
+            self.iconview.set_model(self.models[self.page])
+            self.iconview.set_pixbuf_column(0)
+            self.iconview.set_text_column(-1)
+            self.models_lock.notify_all()
 
     def next(self, widget):
-        print('page now', self.page)
-        self.page = min(self.page + 1, self.len_models)
-        self.iconview.set_model(self.models[self.page])
-        self.iconview.set_pixbuf_column(0)
-        self.iconview.set_text_column(-1)
+        with self.models_lock:
+            print('page now', self.page)
+            self.page = min(self.page + 1, self.len_models)
+            self.iconview.set_model(self.models[self.page])
+            self.iconview.set_pixbuf_column(0)
+            self.iconview.set_text_column(-1)
+            self.models_lock.notify_all()
 
     def selection_changed(self, widget):
         value, path, cell = widget.get_cursor()
@@ -155,7 +284,7 @@ class MainAppGTK:
 
     def load_file_list(self):
         self.builder.get_object('LoadFileListDialog').show()
-        data = {'indeter': True}
+        data = {'indeter': True, 'first_batch': False}
 
         def setval(cur, max):
             data['cur'] = cur
@@ -163,15 +292,25 @@ class MainAppGTK:
             data['indeter'] = False
 
         def load():
-            self.file_list = self.filesystem.get_file_list()
-            setval(0, 1)
-            tags.add_many_pictures(self.file_list, setval)
+            tags.enable_index()
+            self.file_list = []
+            for batch in self.filesystem.iter_file_list():
+                self.file_list.extend(batch)
+                # Only the names of the batch are looked up, so registering it does not slow down as the list grows.
+                # The dialog shows the progress of the first batch; it is closed after that.
+                new = tags.add_many_pictures(batch, None if data['first_batch'] else setval)
+                data['first_batch'] = True
+                if self.new_pictures_selected():
+                    self.append_to_models(new, self.unique_loader_value)
+                self.update_status(f'Scanning files: {len(self.file_list)} found', True)
+            self.refresh_changed()
+            self.update_status('Ready.', False)
 
         t = threading.Thread(target=load, daemon=True)
         t.start()
 
         def check():
-            if not t.isAlive():
+            if data['first_batch'] or not t.is_alive():
                 self.builder.get_object('LoadFileListDialog').destroy()
             else:
                 if data['indeter']:
@@ -182,6 +321,20 @@ class MainAppGTK:
 
         check()
 
+    def refresh_changed(self, batch_size=200):
+        """Remake the thumbnails of files edited since they were made, and reload them on the pages already filled."""
+        for i in range(0, len(self.file_list), batch_size):
+            self.update_status(f'Checking for changed files: {i}/{len(self.file_list)}', True)
+            refreshed = self.pbloader.refresh_stale(self.file_list[i:i + batch_size])
+            if not refreshed:
+                continue
+            with self.models_lock:
+                for page, filled in self.page_filled.items():
+                    if not filled.isdisjoint(refreshed):
+                        filled.difference_update(refreshed)
+                        self.built_models[page] = False
+                self.models_lock.notify_all()
+
     def rebuild_models(self):
         threading.Thread(target=self.load_thumbnails, daemon=True).start()
 
@@ -189,35 +342,98 @@ class MainAppGTK:
         loader_val = str(uuid.uuid4())
         self.unique_loader_value = loader_val[:]  # shallow copy
         self.update_status('Loading image list...', True)
-        page = 0
-        n = 0
-        gn = 0
         #        iconview = self.builder.get_object('PictureIconView')
         #        iconview.set_model(liststore)
         #        iconview.show_all()
-        select = tags.get_pictures_by_tags(self.tags_selected)
+        select = tags.get_pictures_by_tags(self.tags_selected, self.tags_mode)
         if self.unique_loader_value != loader_val:  # another thread running this function is alive, we should stop
             return
-        self.models.clear()
-        self.len_models = 0
-        self.page = 0
-        self.iconview.set_model(self.models[0])
-        self.iconview.set_pixbuf_column(0)
-
-        for i in select:
-            if self.unique_loader_value != loader_val:  # another thread running this function is alive, we should stop
+        with self.models_lock:
+            self.models.clear()
+            self.built_models.clear()
+            self.page_rows.clear()
+            self.page_filled.clear()
+            self.shown = []
+            self.shown_set = set()
+            self.models_generation += 1
+            self.len_models = 0
+            self.page = 0
+            self.iconview.set_model(self.models[0])
+            self.iconview.set_pixbuf_column(0)
+            self.append_to_models(select, loader_val)
+
+    def append_to_models(self, names, loader_val):
+        """Add pictures after the ones already shown. Their thumbnails are loaded by fill_models()."""
+        with self.models_lock:
+            if self.unique_loader_value != loader_val:
                 return
-            n += 1
-            gn += 1
-            self.update_status(f'Loading preview {gn}/{len(select)}', True)
-            if n > self.items_on_page:
-                n = 0
-                self.len_models += 1
-                page += 1
-                print('new page', page)
-            self.models[page].append([self.pbloader[i], i])
-            # time.sleep(0.01)
-        self.update_status('Ready.', False)
+            first_page = len(self.shown) // self.items_on_page
+            for i in names:
+                if i not in self.shown_set:
+                    self.shown_set.add(i)
+                    self.shown.append(i)
+            self.len_models = max(0, len(self.shown) - 1) // self.items_on_page
+            for page in range(first_page, self.len_models + 1):
+                self.built_models[page] = False
+            self.models_lock.notify_all()
+
+    def next_page_to_fill(self):
+        """The unfinished page that is needed most: the current one, then its neighbours, then the rest in order."""
+        order = [self.page]
+        for distance in range(1, self.prefetch_pages + 1):
+            order += [self.page + distance, self.page - distance]
+        for page in itertools.chain(order, range(self.len_models + 1)):
+            if 0 <= page * self.items_on_page < len(self.shown) and not self.built_models[page]:
+                return page
+        return None
+
+    def fill_models(self):
+        """
+        Load thumbnails into the page models for the lifetime of the app, the most needed page first.
+        Changing the page or the picture list interrupts the page being filled; its progress is kept.
+        """
+        while True:
+            with self.models_lock:
+                page = self.next_page_to_fill()
+                while page is None:
+                    self.update_status('Ready.', False)
+                    self.models_lock.wait()
+                    page = self.next_page_to_fill()
+                generation = self.models_generation
+                model = self.models[page]
+                rows = self.page_rows.setdefault(page, dict())
+                filled = self.page_filled[page]
+                for i in self.shown[page * self.items_on_page:(page + 1) * self.items_on_page]:
+                    if i not in rows:
+                        rows[i] = model.append([None, i])
+                todo = [i for i in rows if i not in filled]
+                if not todo:
+                    self.built_models[page] = True
+                    continue
+                self.update_status(f'Loading previews of page {page + 1}/{self.len_models + 1}', True)
+
+            pixbufs = self.pbloader.get_many(todo)
+            try:
+                for i, pixbuf in pixbufs:
+                    with self.models_lock:
+                        if self.models_generation != generation:
+                            break
+                        model.set_value(rows[i], 0, pixbuf)
+                        filled.add(i)
+                        if self.next_page_to_fill() != page:
+                            break
+            finally:
+                pixbufs.close()
+
+    def new_pictures_selected(self) -> bool:
+        """Would the current tag filter show a picture that only has the null tag?"""
+        if self.tags_mode == tags.ALL:
+            return set(self.tags_selected) == {tags.NULL}
+        return tags.NULL in self.tags_selected
+
+    def tag_mode_switched(self, widget):
+        self.tags_mode = tags.ALL if widget.get_active() else tags.ANY
+        self.rebuild_models()
 
     def tag_checkbox_switched(self, widget, tag):
         if widget.get_active():
@@ -254,6 +470,10 @@ class MainAppGTK:
         textbox = gtk.Entry()
         textbox.connect('activate', self.add_new_tag)
         self.tag_box.add(textbox)
+        mode_checkbox = gtk.CheckButton.new_with_label('Match all selected tags')
+        mode_checkbox.set_active(self.tags_mode == tags.ALL)
+        mode_checkbox.connect('toggled', self.tag_mode_switched)
+        self.tag_box.add(mode_checkbox)
         null_checkbox = gtk.CheckButton.new_with_label(tags.NULL)
         null_checkbox.connect('toggled', self.tag_checkbox_switched, tags.NULL)
         null_checkbox.set_active(tags.NULL in self.tags_selected)
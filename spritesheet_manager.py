@@ -1,11 +1,25 @@
 #!/usr/bin/python3
+import array
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import hashlib
+import json
 import logging
+import mmap
+import os
+import struct
+import threading
+import time
 import traceback
 
 import peewee
+import playhouse.migrate
 import pygame
 
 import abstract
+import db_writer
 from legacy import global_variables
 
 l = logging.getLogger(__name__)
@@ -41,11 +55,17 @@ class ThumbnailScale(BaseModel):
     width = peewee.IntegerField()
     height = peewee.IntegerField()
 
+    class Meta:
+        indexes = ((('width', 'height'), True),)
+
 
 class Picture(BaseModel):
-    name = peewee.CharField()
+    name = peewee.CharField(unique=True)
     width = peewee.IntegerField()
     height = peewee.IntegerField()
+    fingerprint = peewee.CharField(null=True, index=True)
+    mtime = peewee.IntegerField(null=True)
+    file_size = peewee.IntegerField(null=True)
 
 
 class Spritesheet(BaseModel):
@@ -62,34 +82,362 @@ class Thumbnail(BaseModel):
     width = peewee.IntegerField()
     height = peewee.IntegerField()
 
+    class Meta:
+        indexes = (
+            (('picture', 'scale'), True),
+            (('spritesheet', 'x', 'y'), False),  # the thumbnails that share a cell
+        )
+
+
+def add_missing_columns(model):
+    """Add the columns, and their indexes, that were added to a model after its table had been created."""
+    table = model._meta.table_name
+    if not db.table_exists(table):
+        return
+    existing = {column.name for column in db.get_columns(table)}
+    migrator = playhouse.migrate.SqliteMigrator(db)
+    operations = []
+    for field in model._meta.sorted_fields:
+        if field.column_name not in existing:
+            l.info('Adding column %s to table %s.', field.column_name, table)
+            operations.append(migrator.add_column(table, field.column_name, field))
+    if operations:
+        playhouse.migrate.migrate(*operations)
+
+
+def merge_duplicate_rows(model, fields, references=(), keep_last=False):
+    """
+    Make the rows of a model unique on 'fields' before a unique index is added to a table made without one.
+    One row of every group of duplicates is kept, the first or the last one, and the foreign keys in 'references'
+    are pointed at it. Nothing is done once the index exists.
+    """
+    table = model._meta.table_name
+    index = '_'.join([table] + [model._meta.fields[i].column_name for i in fields])
+    if not db.table_exists(table) or index in {i.name for i in db.get_indexes(table)}:
+        return
+    columns = [model._meta.fields[i] for i in fields]
+    keep = dict()
+    removed = 0
+    with db.atomic():
+        for row in model.select(model.id, *columns).order_by(model.id.desc() if keep_last else model.id).tuples():
+            if row[1:] not in keep:
+                keep[row[1:]] = row[0]
+                continue
+            for field in references:
+                if db.table_exists(field.model._meta.table_name):
+                    field.model.update({field: keep[row[1:]]}).where(field == row[0]).execute()
+            model.delete_by_id(row[0])
+            removed += 1
+    if removed:
+        l.info('Removed %d duplicate rows from table %s.', removed, table)
 
-db.create_tables([ThumbnailScale, Picture, Spritesheet, Thumbnail])
 
 DEFAULT_WIDTH = DEFAULT_HEIGHT = 2048
 
+DEFAULT_CACHE_BUDGET = 256 * 1024 * 1024
+DEFAULT_FLUSH_INTERVAL = 5.0
+DEFAULT_FLUSH_EVERY = 500
+PLACEHOLDER_COLOR = (128, 128, 128)
+PNG = 'png'
+RAW = 'raw'
+RAW_MAGIC = b'TNRAW1'
+RAW_HEADER = struct.Struct('<6sIIB')  # magic, width, height, bytes per pixel; rows of RGB(A) pixels follow
+
+
+def save_raw(surface: pygame.Surface, path: str):
+    """Write a surface as an uncompressed RAW sheet, replacing the old file atomically."""
+    mode = 'RGBA' if surface.get_flags() & pygame.SRCALPHA else 'RGB'
+    with open(path + '.tmp', 'wb') as file:
+        file.write(RAW_HEADER.pack(RAW_MAGIC, surface.get_width(), surface.get_height(), len(mode)))
+        file.write(pygame.image.tostring(surface, mode))
+    os.replace(path + '.tmp', path)
+
+
+def convert_sheet_files(to_format: str, keep_old=False) -> int:
+    """
+    Convert every sheet in spritesheets/ to RAW or back to PNG, and return how many were converted.
+    The old files are removed unless 'keep_old' is True.
+    """
+    from_format = PNG if to_format == RAW else RAW
+    converted = 0
+    for file_name in sorted(os.listdir('spritesheets')):
+        key, ext = os.path.splitext(file_name)
+        if ext != '.' + from_format:
+            continue
+        path = f'spritesheets/{file_name}'
+        if from_format == PNG:
+            save_raw(pygame.image.load(path), f'spritesheets/{key}.raw')
+        else:
+            with open(path, 'rb') as file:
+                magic, width, height, bytes_per_pixel = RAW_HEADER.unpack(file.read(RAW_HEADER.size))
+                surface = pygame.image.fromstring(file.read(), (width, height),
+                                                  'RGBA' if bytes_per_pixel == 4 else 'RGB')
+            pygame.image.save(surface, f'spritesheets/{key}.png')
+        if not keep_old:
+            os.remove(path)
+        converted += 1
+        l.info('Converted spritesheet %s to %s.', key, to_format)
+    return converted
+
+
 class LazySpritesheetLoader: # consider putting spritesheets into database.
-    def __init__(self):
-        self.cache = dict()
+    def __init__(self, budget=DEFAULT_CACHE_BUDGET, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 flush_every=DEFAULT_FLUSH_EVERY, sheet_format=PNG):
+        """
+        Loads spritesheets on demand and keeps them in memory.
+
+        At most 'budget' bytes of sheet pixels are kept (None means no limit);
+        beyond that, the least recently used sheets are dropped. Pinned sheets are never dropped.
+
+        Changed sheets are saved later: every 'flush_interval' seconds, after 'flush_every' changes,
+        when they are evicted and at exit. 'on_flush' is called with the key of every sheet just saved.
+
+        'sheet_format' is PNG or RAW. RAW sheets are uncompressed and memory-mapped, so a single thumbnail
+        can be read without loading its whole sheet. A RAW loader still reads PNG sheets that were not converted.
+        """
+        self.cache = collections.OrderedDict()
         self.deltas_without_save = dict()
+        self.budget = budget
+        self.cache_bytes = 0
+        self.pinned = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+        self.dirty: {str: int} = dict()
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self.flusher = None
+        self.on_flush = None
+        self.sheet_format = sheet_format
+        self.maps: {str: (mmap.mmap, int, int, str)} = dict()
+        self.region_reads = 0
+        self.versions: {str: int} = dict()
+        self.last_version = 0
+        atexit.register(self.flush_all)
+
+    @staticmethod
+    def surface_bytes(surface: pygame.Surface) -> int:
+        return surface.get_pitch() * surface.get_height()
 
     def __getitem__(self, item) -> pygame.Surface:
         l.debug('Loading spritesheet %s...', item)
-        if str(item) in self.cache:
-            l.debug('It was found in the cache.')
-            return self.cache[str(item)]
-        else:
-            l.debug('It was not found in the spritesheet cache, loading from filesystem.')
-            try:
-                self.cache.update({str(item): pygame.image.load(f'spritesheets/{item}.png')})
+        with self.lock:
+            if str(item) in self.cache:
+                l.debug('It was found in the cache.')
+                self.hits += 1
+                self.cache.move_to_end(str(item))
                 return self.cache[str(item)]
-            except pygame.error:
-                l.info('Spritesheet is broken or missing: ' + traceback.format_exc())
-                return pygame.Surface((DEFAULT_WIDTH, DEFAULT_HEIGHT))
+            else:
+                l.debug('It was not found in the spritesheet cache, loading from filesystem.')
+                self.misses += 1
+                try:
+                    self.put(str(item), self.load(str(item)))
+                    return self.cache[str(item)]
+                except (pygame.error, FileNotFoundError, ValueError):
+                    l.info('Spritesheet is broken or missing: ' + traceback.format_exc())
+                    return pygame.Surface((DEFAULT_WIDTH, DEFAULT_HEIGHT))
 
     def __setitem__(self, key, value: pygame.Surface):
-        self.cache[key]=value
-        with global_variables.global_quit_lock:
-            pygame.image.save(value, f'spritesheets/{key}.png')
+        with self.lock:
+            self.mark_dirty(key, value)
+            self.flush(key)
+            self.evict()
+
+    def mark_dirty(self, key, value: pygame.Surface):
+        """Put a changed sheet into the cache. It stays pinned until it has been saved."""
+        key = str(key)
+        with self.lock:
+            self.touch(key)
+            self.pinned.add(key)
+            self.dirty[key] = self.dirty.get(key, 0) + 1
+            self.put(key, value)
+            if self.dirty[key] >= self.flush_every:
+                self.flush(key)
+            if self.flusher is None and self.flush_interval is not None:
+                self.flusher = threading.Thread(target=self.flush_periodically, daemon=True)
+                self.flusher.start()
+
+    def touch(self, key):
+        """Note that the pixels of a sheet changed, so copies made from it are out of date."""
+        with self.lock:
+            self.last_version += 1
+            self.versions[str(key)] = self.last_version
+
+    def version(self, key) -> int:
+        """A number that changes whenever the pixels of the sheet change."""
+        return self.versions.get(str(key), 0)
+
+    def flush(self, key):
+        """Save a changed sheet, then unpin it."""
+        key = str(key)
+        with self.lock:
+            if key not in self.dirty:
+                return
+            l.debug('Saving spritesheet %s after %d changes.', key, self.dirty[key])
+            with global_variables.global_quit_lock:
+                self.save(key, self.cache[key])
+            del self.dirty[key]
+            try:
+                if self.on_flush is not None:
+                    self.on_flush(key)
+            finally:
+                self.pinned.discard(key)
+
+    def load(self, key: str) -> pygame.Surface:
+        if self.sheet_format == RAW:
+            mapped = self.open_raw(key)
+            if mapped is not None:
+                data, width, height, mode = mapped
+                return pygame.image.fromstring(data[RAW_HEADER.size:], (width, height), mode)
+        return pygame.image.load(f'spritesheets/{key}.png')
+
+    def save(self, key: str, surface: pygame.Surface):
+        if self.sheet_format == RAW:
+            save_raw(surface, f'spritesheets/{key}.raw')
+            old = self.maps.pop(key, None)
+            if old is not None:
+                old[0].close()
+        else:
+            pygame.image.save(surface, f'spritesheets/{key}.png')
+
+    def open_raw(self, key: str):
+        """Memory-map a RAW sheet. Returns the map, width, height and pixel mode, or None if there is no such file."""
+        with self.lock:
+            if key not in self.maps:
+                try:
+                    with open(f'spritesheets/{key}.raw', 'rb') as file:
+                        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                except (FileNotFoundError, ValueError):
+                    return None
+                magic, width, height, bytes_per_pixel = RAW_HEADER.unpack_from(data)
+                if magic != RAW_MAGIC or len(data) != RAW_HEADER.size + width * height * bytes_per_pixel:
+                    data.close()
+                    raise ValueError(f'spritesheets/{key}.raw is not a valid raw spritesheet')
+                self.maps[key] = (data, width, height, 'RGBA' if bytes_per_pixel == 4 else 'RGB')
+            return self.maps[key]
+
+    def get_area(self, key, area: pygame.Rect, copy=True):
+        """
+        Get a part of a sheet. A cached sheet is cut from memory;
+        for a RAW sheet that is not cached, only the rows of the area are read from the file.
+
+        If 'copy' is False, a part of a cached sheet is returned as a subsurface that shares the sheet's pixels.
+        It must not be drawn on.
+        """
+        key = str(key)
+        with self.lock:
+            if key not in self.cache and self.sheet_format == RAW:
+                try:
+                    mapped = self.open_raw(key)
+                except ValueError:
+                    l.info('Spritesheet is broken: ' + traceback.format_exc())
+                    mapped = None
+                if mapped is not None:
+                    data, width, height, mode = mapped
+                    if pygame.Rect(0, 0, width, height).contains(area):
+                        self.region_reads += 1
+                        row_bytes = area.width * len(mode)
+                        offsets = (RAW_HEADER.size + ((area.top + y) * width + area.left) * len(mode)
+                                   for y in range(area.height))
+                        pixels = b''.join(data[i:i + row_bytes] for i in offsets)
+                        return pygame.image.fromstring(pixels, area.size, mode)
+            if not copy:
+                return self[key].subsurface(area)
+            return self.cut_out(self[key], area)
+
+    def flush_all(self):
+        with self.lock:
+            for key in list(self.dirty):
+                self.flush(key)
+            self.evict()
+
+    def flush_periodically(self):
+        """Save changed sheets every flush_interval. A sheet that cannot be saved stays dirty and is tried again."""
+        while True:
+            time.sleep(self.flush_interval)
+            with self.lock:
+                keys = list(self.dirty)
+            for key in keys:
+                try:
+                    self.flush(key)
+                except Exception:
+                    l.error('Could not save spritesheet %s, trying again in %s seconds: %s',
+                            key, self.flush_interval, traceback.format_exc())
+            try:
+                self.evict()
+            except Exception:
+                l.error('Could not evict spritesheets: %s', traceback.format_exc())
+
+    def put(self, key: str, value: pygame.Surface):
+        with self.lock:
+            if key in self.cache:
+                self.cache_bytes -= self.surface_bytes(self.cache.pop(key))
+            self.cache[key] = value
+            self.cache_bytes += self.surface_bytes(value)
+            self.evict()
+
+    def pin(self, key):
+        """Keep this sheet in memory until it is unpinned, for example while it has unsaved changes."""
+        with self.lock:
+            self.pinned.add(str(key))
+
+    def unpin(self, key):
+        with self.lock:
+            self.pinned.discard(str(key))
+            self.evict()
+
+    def evict(self):
+        """Drop least recently used sheets until the cache fits the budget, saving them first if they changed."""
+        with self.lock:
+            if self.budget is None:
+                return
+            for key in list(self.cache):
+                if self.cache_bytes <= self.budget:
+                    break
+                if key in self.dirty:
+                    self.flush(key)
+                if key in self.pinned:
+                    continue
+                l.debug('Evicting spritesheet %s from the cache.', key)
+                self.cache_bytes -= self.surface_bytes(self.cache.pop(key))
+                self.evictions += 1
+
+    def discard(self, key):
+        """Forget a sheet that is no longer used, including unsaved changes, and delete its files."""
+        key = str(key)
+        with self.lock:
+            self.touch(key)
+            if key in self.cache:
+                self.cache_bytes -= self.surface_bytes(self.cache.pop(key))
+            self.dirty.pop(key, None)
+            self.pinned.discard(key)
+            mapped = self.maps.pop(key, None)
+            if mapped is not None:
+                mapped[0].close()
+            for ext in (PNG, RAW):
+                try:
+                    os.remove(f'spritesheets/{key}.{ext}')
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        """Forget every sheet, including unsaved changes."""
+        with self.lock:
+            for data, _, _, _ in self.maps.values():
+                data.close()
+            self.maps.clear()
+            self.cache.clear()
+            self.cache_bytes = 0
+            self.dirty.clear()
+            self.pinned.clear()
+
+    def stats(self) -> dict:
+        """Cache counters, for choosing a budget."""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'region_reads': self.region_reads,
+                    'sheets': len(self.cache), 'bytes': self.cache_bytes, 'budget': self.budget}
 
     @staticmethod
     def cut_out(sheet: pygame.Surface, area: pygame.Rect) -> pygame.Surface:
@@ -99,101 +447,1141 @@ class LazySpritesheetLoader: # consider putting spritesheets into database.
         return output
 
 
+class FreeSpace(BaseModel):
+    spritesheet = peewee.ForeignKeyField(Spritesheet, backref='free_space', unique=True)
+    rects = peewee.TextField()
+
+
+class Atlas(BaseModel):
+    spritesheet = peewee.ForeignKeyField(Spritesheet, backref='atlas', unique=True)
+    scale = peewee.ForeignKeyField(ThumbnailScale, backref='atlases')
+    columns = peewee.IntegerField()
+    rows = peewee.IntegerField()
+    used = peewee.BlobField()
+
+
+add_missing_columns(Picture)
+merge_duplicate_rows(ThumbnailScale, ('width', 'height'), (Thumbnail.scale, Atlas.scale))
+merge_duplicate_rows(Picture, ('name',), (Thumbnail.picture,))
+# Of two thumbnails of a picture at one scale, the newer one is kept; compact() reclaims the cell of the other.
+merge_duplicate_rows(Thumbnail, ('picture', 'scale'), keep_last=True)
+db.create_tables([ThumbnailScale, Picture, Spritesheet, Thumbnail, FreeSpace, Atlas])
+# Every write after this point goes through the writer thread; the migrations above run before any other thread.
+writer = db_writer.DatabaseWriter(db)
+
+
+class MaxRectsBin:
+    def __init__(self, width: int, height: int, free_rects: [pygame.Rect] = None):
+        """
+        Free-space map of a single spritesheet, using the MaxRects algorithm.
+
+        The map is a list of maximal free rectangles, which may overlap each other.
+        A new rect is placed into the free rectangle that leaves the shortest leftover side (best short side fit).
+        """
+        self.width = width
+        self.height = height
+        self.free_rects = [pygame.Rect(0, 0, width, height)] if free_rects is None else free_rects
+        self.update_limits()
+
+    def update_limits(self):
+        self.max_free_width = max((r.width for r in self.free_rects), default=0)
+        self.max_free_height = max((r.height for r in self.free_rects), default=0)
+
+    def could_fit(self, width: int, height: int) -> bool:
+        return width <= self.max_free_width and height <= self.max_free_height
+
+    def find_position(self, width: int, height: int):
+        best = None
+        best_score = None
+        for free in self.free_rects:
+            if free.width >= width and free.height >= height:
+                score = (min(free.width - width, free.height - height), max(free.width - width, free.height - height))
+                if best_score is None or score < best_score:
+                    best, best_score = free.topleft, score
+        return best
+
+    def insert(self, width: int, height: int):
+        """Place a rect of this size and return it, or None if it does not fit."""
+        if not self.could_fit(width, height):
+            return None
+        position = self.find_position(width, height)
+        if position is None:
+            return None
+        rect = pygame.Rect(position, (width, height))
+        self.occupy(rect)
+        return rect
+
+    def occupy(self, used: pygame.Rect):
+        """Remove the area of a used rect from the free-space map."""
+        new_free = []
+        for free in self.free_rects:
+            if not free.colliderect(used):
+                new_free.append(free)
+                continue
+            if used.left > free.left:
+                new_free.append(pygame.Rect(free.left, free.top, used.left - free.left, free.height))
+            if used.right < free.right:
+                new_free.append(pygame.Rect(used.right, free.top, free.right - used.right, free.height))
+            if used.top > free.top:
+                new_free.append(pygame.Rect(free.left, free.top, free.width, used.top - free.top))
+            if used.bottom < free.bottom:
+                new_free.append(pygame.Rect(free.left, used.bottom, free.width, free.bottom - used.bottom))
+        self.free_rects = self.prune(new_free)
+        self.update_limits()
+
+    def release(self, rect: pygame.Rect):
+        """Return the area of a rect that is no longer used to the free-space map."""
+        self.free_rects = self.prune(self.free_rects + [pygame.Rect(rect)])
+        self.update_limits()
+
+    @staticmethod
+    def prune(rects: [pygame.Rect]) -> [pygame.Rect]:
+        """Drop every free rect that is contained in another one."""
+        rects = sorted(rects, key=lambda r: r.width * r.height, reverse=True)
+        output = []
+        for rect in rects:
+            if not any(other.contains(rect) for other in output):
+                output.append(rect)
+        return output
+
+    def dumps(self) -> str:
+        return json.dumps([tuple(r) for r in self.free_rects])
+
+    @classmethod
+    def loads(cls, width: int, height: int, data: str):
+        return cls(width, height, [pygame.Rect(r) for r in json.loads(data)])
+
+
 class Packer:
     def __init__(self):
-        self.sheets: {object: [pygame.Rect]} = dict()
-        self.sheet_sizes: {str: pygame.Rect} = dict()
+        """
+        Packs thumbnail rects into spritesheets.
+
+        The free-space map of every sheet is kept in memory, so placing a rect does not read the database.
+        The maps are stored in the FreeSpace table and loaded once, the first time a rect is added.
+        """
+        self.bins: {int: MaxRectsBin} = None
+        self.sheets: {int: Spritesheet} = dict()
+        self.last_used = None
+
+    def load(self):
+        self.bins = dict()
+        self.sheets = dict()
+        stored = {f.spritesheet_id: f.rects for f in FreeSpace.select()}
+        for sheet in Spritesheet.select().where(Spritesheet.id.not_in(Atlas.select(Atlas.spritesheet))):
+            if sheet.id in stored:
+                self.bins[sheet.id] = MaxRectsBin.loads(sheet.width, sheet.height, stored[sheet.id])
+            else:
+                l.info('Spritesheet %s has no free-space map, rebuilding it from its thumbnails.', sheet.id)
+                self.bins[sheet.id] = MaxRectsBin(sheet.width, sheet.height)
+                for t in sheet.thumbnails:
+                    self.bins[sheet.id].occupy(pygame.Rect(t.x, t.y, t.width, t.height))
+                self.persist(sheet)
+            self.sheets[sheet.id] = sheet
 
     def add_rect(self, new_rect: pygame.Rect):
-        for sheet in Spritesheet.select():
-            rects = [pygame.Rect(t.x,t.y,t.width,t.height) for t in sheet.thumbnails]
-            sheet_rect = pygame.Rect(0,0,sheet.height, sheet.width)
-            for rect in rects:
-                crects = rects.copy()
-                crects.remove(rect)
-                new_rect.topleft = rect.topright
-                if new_rect.collidelist(crects) == -1:
-                    if sheet_rect.contains(new_rect):
-                        return sheet, new_rect
-                new_rect.topleft = rect.bottomright
-                if new_rect.collidelist(crects) == -1:
-                    if sheet_rect.contains(new_rect):
-                        return sheet, new_rect
-                new_rect.topright = rect.topleft
-                if new_rect.collidelist(crects) == -1:
-                    if sheet_rect.contains(new_rect):
-                        return sheet, new_rect
-                new_rect.topright = rect.bottomleft
-                if new_rect.collidelist(crects) == -1:
-                    if sheet_rect.contains(new_rect):
-                        return sheet, new_rect
-        sheet = Spritesheet.create(height=DEFAULT_HEIGHT, width=DEFAULT_WIDTH)
-        new_rect.topleft = (0, 0)
-        return sheet, new_rect
-
-    def inform_new_sheet(self, sheet: str, size: (int, int)):
-        self.sheet_sizes.update({sheet: size})
+        if self.bins is None:
+            self.load()
+        width, height = new_rect.size
+        order = list(self.bins)
+        if self.last_used in self.bins:
+            order.remove(self.last_used)
+            order.insert(0, self.last_used)
+        for sheet_id in order:
+            rect = self.bins[sheet_id].insert(width, height)
+            if rect is not None:
+                self.last_used = sheet_id
+                return self.sheets[sheet_id], rect
+        sheet = writer.run(Spritesheet.create, width=max(DEFAULT_WIDTH, width), height=max(DEFAULT_HEIGHT, height))
+        self.bins[sheet.id] = MaxRectsBin(sheet.width, sheet.height)
+        self.sheets[sheet.id] = sheet
+        self.last_used = sheet.id
+        return sheet, self.bins[sheet.id].insert(width, height)
+
+    @writer.writing
+    def persist(self, sheet: Spritesheet):
+        """Store the free-space map of this sheet in the database."""
+        FreeSpace.insert(spritesheet=sheet, rects=self.bins[sheet.id].dumps()).on_conflict_replace().execute()
+
+    def release(self, sheet_id: int, rect: pygame.Rect) -> bool:
+        """Free the space of a thumbnail. Returns False if the sheet is not packed by this packer."""
+        if self.bins is None:
+            self.load()
+        if sheet_id not in self.bins:
+            return False
+        self.bins[sheet_id].release(rect)
+        self.persist(self.sheets[sheet_id])
+        return True
+
+    def forget(self, sheet: Spritesheet):
+        if self.bins is not None:
+            self.bins.pop(sheet.id, None)
+            self.sheets.pop(sheet.id, None)
+
+    def reset(self):
+        self.bins = None
+        self.sheets = dict()
+        self.last_used = None
+
+
+class GridAtlas:
+    def __init__(self, cell_width: int, cell_height: int, columns: int, rows: int, used: int = 0):
+        """
+        A spritesheet split into fixed cells of one ThumbnailScale.
+
+        Cell n is at column n % columns, row n // columns, so a cell index alone gives the position.
+        Occupied cells are the set bits of the 'used' bitmap.
+        """
+        self.cell_width = cell_width
+        self.cell_height = cell_height
+        self.columns = columns
+        self.rows = rows
+        self.used = used
+
+    @property
+    def cells(self) -> int:
+        return self.columns * self.rows
+
+    def allocate(self):
+        """Take the lowest free cell and return its index, or None if the atlas is full."""
+        index = ((~self.used) & (self.used + 1)).bit_length() - 1
+        if index >= self.cells:
+            return None
+        self.used |= 1 << index
+        return index
+
+    def release(self, index: int):
+        self.used &= ~(1 << index)
+
+    def cell_rect(self, index: int) -> pygame.Rect:
+        return pygame.Rect((index % self.columns) * self.cell_width, (index // self.columns) * self.cell_height,
+                           self.cell_width, self.cell_height)
+
+    def cell_index(self, x: int, y: int) -> int:
+        return (y // self.cell_height) * self.columns + x // self.cell_width
+
+    def dumps(self) -> bytes:
+        return self.used.to_bytes((self.cells + 7) // 8, 'little')
+
+    @classmethod
+    def loads(cls, cell_width: int, cell_height: int, columns: int, rows: int, data: bytes):
+        return cls(cell_width, cell_height, columns, rows, int.from_bytes(data, 'little'))
+
+
+class AtlasPacker:
+    def __init__(self):
+        """
+        Packs thumbnails into fixed-cell spritesheets, one set of sheets per ThumbnailScale.
+
+        Thumbnails are fitted into their scale, so every one of them fits a cell and no collision checks are needed.
+        """
+        self.atlases: {int: {int: GridAtlas}} = None
+        self.sheets: {int: Spritesheet} = dict()
+
+    def load(self):
+        self.atlases = dict()
+        self.sheets = dict()
+        for atlas in Atlas.select(Atlas, Spritesheet, ThumbnailScale).join(Spritesheet).switch(Atlas).join(
+                ThumbnailScale):
+            grid = GridAtlas.loads(atlas.scale.width, atlas.scale.height, atlas.columns, atlas.rows, atlas.used)
+            self.atlases.setdefault(atlas.scale.id, dict())[atlas.spritesheet.id] = grid
+            self.sheets[atlas.spritesheet.id] = atlas.spritesheet
+
+    def fits(self, new_rect: pygame.Rect, scale: ThumbnailScale) -> bool:
+        return new_rect.width <= scale.width and new_rect.height <= scale.height \
+               and scale.width <= DEFAULT_WIDTH and scale.height <= DEFAULT_HEIGHT
+
+    def add_rect(self, new_rect: pygame.Rect, scale: ThumbnailScale):
+        if self.atlases is None:
+            self.load()
+        grids = self.atlases.setdefault(scale.id, dict())
+        for sheet_id, grid in grids.items():
+            index = grid.allocate()
+            if index is not None:
+                return self.sheets[sheet_id], pygame.Rect(grid.cell_rect(index).topleft, new_rect.size)
+        grid = GridAtlas(scale.width, scale.height, DEFAULT_WIDTH // scale.width, DEFAULT_HEIGHT // scale.height)
+        sheet = self.create_sheet(scale, grid)
+        grids[sheet.id] = grid
+        self.sheets[sheet.id] = sheet
+        return sheet, pygame.Rect(grid.cell_rect(grid.allocate()).topleft, new_rect.size)
+
+    @staticmethod
+    @writer.writing
+    def create_sheet(scale: ThumbnailScale, grid: GridAtlas) -> Spritesheet:
+        sheet = Spritesheet.create(width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT)
+        Atlas.create(spritesheet=sheet, scale=scale, columns=grid.columns, rows=grid.rows, used=grid.dumps())
+        return sheet
+
+    def find(self, sheet: Spritesheet):
+        if self.atlases is None:
+            self.load()
+        for grids in self.atlases.values():
+            if sheet.id in grids:
+                return grids[sheet.id]
+        return None
+
+    @writer.writing
+    def persist(self, sheet: Spritesheet):
+        """Store the used-cell bitmap of this sheet in the database."""
+        grid = self.find(sheet)
+        Atlas.update(used=grid.dumps()).where(Atlas.spritesheet == sheet).execute()
+
+    def release(self, sheet_id: int, rect: pygame.Rect) -> bool:
+        """Free the cell of a thumbnail. Returns False if the sheet is not an atlas."""
+        grid = self.find(Spritesheet(id=sheet_id))
+        if grid is None:
+            return False
+        grid.release(grid.cell_index(rect.x, rect.y))
+        self.persist(self.sheets[sheet_id])
+        return True
+
+    def forget(self, sheet: Spritesheet):
+        if self.atlases is not None:
+            for grids in self.atlases.values():
+                grids.pop(sheet.id, None)
+            self.sheets.pop(sheet.id, None)
+
+    def reset(self):
+        self.atlases = None
+        self.sheets = dict()
+
+
+class LocationIndex:
+    def __init__(self):
+        """
+        Where every stored thumbnail is, kept in memory so that warm lookups do not query the database.
+
+        Thumbnails are rows of parallel arrays of picture id, scale id, sheet id, x, y, width and height.
+        The rows of a picture form a chain: 'first' is indexed by picture id, and 'next' links the rows after it.
+        Names are found by their hash in a sorted array, and a match is confirmed by a second, independent hash;
+        names added later, and the few whose hashes collide, are kept in a dict.
+        That is about 60 bytes per thumbnail and picture, instead of a dict of path strings.
+
+        Changes are made under 'lock'. Lookups do not take it, since a row is only linked once it is filled in.
+        """
+        self.lock = threading.Lock()
+        self.picture = array.array('i')
+        self.scale = array.array('i')
+        self.sheet = array.array('i')  # -1 for the rows of deleted sheets
+        self.x = array.array('i')
+        self.y = array.array('i')
+        self.width = array.array('i')
+        self.height = array.array('i')
+        self.next = array.array('i')
+        self.first = array.array('i')
+        self.name_hashes = array.array('q')
+        self.name_checks = array.array('q')
+        self.name_ids = array.array('i')
+        self.extra_names: {str: int} = dict()
+
+    @staticmethod
+    def name_check(name: str) -> int:
+        return int.from_bytes(hashlib.blake2b(name.encode('utf-8', 'surrogatepass'), digest_size=8).digest(),
+                              'little', signed=True)
+
+    @classmethod
+    def load(cls):
+        index = cls()
+        hashes = array.array('q')
+        checks = array.array('q')
+        ids = array.array('i')
+        for picture_id, name in Picture.select(Picture.id, Picture.name).tuples():
+            hashes.append(hash(name))
+            checks.append(cls.name_check(name))
+            ids.append(picture_id)
+        order = sorted(range(len(hashes)), key=hashes.__getitem__)
+        index.name_hashes = array.array('q', (hashes[i] for i in order))
+        index.name_checks = array.array('q', (checks[i] for i in order))
+        index.name_ids = array.array('i', (ids[i] for i in order))
+        collisions = {a for a, b in zip(index.name_hashes, index.name_hashes[1:]) if a == b}
+        if collisions:
+            keep = [i for i, h in enumerate(index.name_hashes) if h not in collisions]
+            index.name_hashes = array.array('q', (index.name_hashes[i] for i in keep))
+            index.name_checks = array.array('q', (index.name_checks[i] for i in keep))
+            index.name_ids = array.array('i', (index.name_ids[i] for i in keep))
+            for picture_id, name in Picture.select(Picture.id, Picture.name).tuples():
+                if hash(name) in collisions:
+                    index.extra_names[name] = picture_id
+        for row in Thumbnail.select(Thumbnail.picture, Thumbnail.scale, Thumbnail.spritesheet, Thumbnail.x,
+                                    Thumbnail.y, Thumbnail.width, Thumbnail.height).order_by(Thumbnail.id).tuples():
+            index.add(*row)
+        l.info('Loaded the locations of %d thumbnails, taking %d bytes.', len(index.sheet), index.memory())
+        return index
+
+    def picture_id(self, name: str):
+        """The id of the picture with this name (a repr, as in the database), or None if it is not known."""
+        picture_id = self.extra_names.get(name)
+        if picture_id is not None:
+            return picture_id
+        key = hash(name)
+        i = bisect.bisect_left(self.name_hashes, key)
+        if i < len(self.name_hashes) and self.name_hashes[i] == key and self.name_checks[i] == self.name_check(name):
+            return self.name_ids[i]
+        return None
+
+    def add_picture(self, name: str, picture_id: int):
+        with self.lock:
+            if self.picture_id(name) != picture_id:
+                self.extra_names[name] = picture_id
+
+    def add(self, picture_id: int, scale_id: int, sheet_id: int, x: int, y: int, width: int, height: int):
+        """Record a thumbnail. It replaces an older one of the same picture at the same scale."""
+        with self.lock:
+            row = len(self.sheet)
+            if picture_id >= len(self.first):
+                self.first.extend(array.array('i', [-1]) * (picture_id + 1 - len(self.first)))
+            for column, value in ((self.picture, picture_id), (self.scale, scale_id), (self.sheet, sheet_id),
+                                  (self.x, x), (self.y, y), (self.width, width), (self.height, height),
+                                  (self.next, self.first[picture_id])):
+                column.append(value)
+            # Linked last, so a lookup never sees a row that is not filled in yet.
+            self.first[picture_id] = row
+
+    def find(self, picture_id: int, scale_id: int):
+        """The sheet id and rect of a thumbnail, or None."""
+        if picture_id is None or picture_id >= len(self.first):
+            return None
+        row = self.first[picture_id]
+        while row >= 0:
+            if self.scale[row] == scale_id and self.sheet[row] >= 0:
+                return self.sheet[row], pygame.Rect(self.x[row], self.y[row], self.width[row], self.height[row])
+            row = self.next[row]
+        return None
+
+    def remove_pictures(self, picture_ids):
+        """Forget every thumbnail of these pictures."""
+        with self.lock:
+            for i in picture_ids:
+                if i < len(self.first):
+                    self.first[i] = -1
+
+    def remove_sheet(self, sheet_id: int):
+        with self.lock:
+            for row, value in enumerate(self.sheet):
+                if value == sheet_id:
+                    self.sheet[row] = -1
+
+    def memory(self) -> int:
+        """The bytes taken by the arrays."""
+        return sum(len(i) * i.itemsize for i in (self.picture, self.scale, self.sheet, self.x, self.y, self.width,
+                                                  self.height, self.next, self.first, self.name_hashes,
+                                                  self.name_checks, self.name_ids))
+
 
 class SpritesheetManager(metaclass=abstract.Singleton):
-    def __init__(self, file: str, fs: abstract.FileSystemInterface):
+    def __init__(self, file: str, fs: abstract.FileSystemInterface, atlas=False, workers=None,
+                 cache_budget=DEFAULT_CACHE_BUDGET, sheet_format=PNG, location_index=False):
+        """
+        If 'atlas' is True, thumbnails that fit their ThumbnailScale are stored in fixed-cell atlas sheets
+        instead of being packed by the general-purpose packer.
+
+        'workers' is the number of processes get_thumbnails() decodes images with; None means one per CPU.
+        'cache_budget' is how many bytes of spritesheets are kept in memory.
+        'sheet_format' is how spritesheets are stored on disk, PNG or RAW.
+        If 'location_index' is True, the locations of all thumbnails are loaded into a LocationIndex now,
+        and stored thumbnails are found without querying the database.
+        """
         self.fs = fs
-        self.ssl = LazySpritesheetLoader()
+        self.ssl = LazySpritesheetLoader(cache_budget, sheet_format=sheet_format)
         self.cache = {}
         self.packer = Packer()
+        self.atlas_packer = AtlasPacker() if atlas else None
+        # Guards the packers, from finding a place for a thumbnail until it is blitted and pending,
+        # so that threads that store at the same time never get the same cell. It is taken before the others.
+        self.pack_lock = threading.Lock()
+        self.workers = workers
+        self.pool = None
+        self.pending: {(str, int): dict} = dict()
+        self.pending_sheets: {str: (object, Spritesheet, [(str, int)])} = dict()
+        # Guards the two above. It is taken last and held briefly, so that the writer thread can take it too.
+        self.pending_lock = threading.Lock()
+        self.scales: {(int, int): ThumbnailScale} = dict()
+        self.locations = LocationIndex.load() if location_index else None
+        self.ssl.on_flush = self.sheet_flushed
+
+    def get_scale(self, size: (int, int)) -> ThumbnailScale:
+        """The ThumbnailScale of this size, which is only looked up in the database once."""
+        size = tuple(size)
+        if size not in self.scales:
+            self.scales[size], _ = writer.run(ThumbnailScale.get_or_create, width=size[0], height=size[1])
+        return self.scales[size]
+
+    def pack(self, new_rect: pygame.Rect, scale: ThumbnailScale):
+        """Find a place for a thumbnail. Returns the packer that placed it, the spritesheet and the rect."""
+        if self.atlas_packer is not None and self.atlas_packer.fits(new_rect, scale):
+            return (self.atlas_packer, *self.atlas_packer.add_rect(new_rect, scale))
+        return (self.packer, *self.packer.add_rect(new_rect))
 
     def clear_cache(self):
+        writer.flush()
         self.cache.clear()
-        self.ssl.cache.clear()
-        db.drop_tables([Thumbnail, ThumbnailScale, Picture, Spritesheet])
-        db.create_tables([Thumbnail, ThumbnailScale, Picture, Spritesheet])
+        self.scales.clear()
+        if self.locations is not None:
+            self.locations = LocationIndex()
+        with self.ssl.lock:
+            self.ssl.clear()
+            with self.pending_lock:
+                self.pending.clear()
+                self.pending_sheets.clear()
+        with self.pack_lock:
+            self.packer.reset()
+            if self.atlas_packer is not None:
+                self.atlas_packer.reset()
+        writer.run(db.drop_tables, [Atlas, FreeSpace, Thumbnail, ThumbnailScale, Picture, Spritesheet])
+        writer.run(db.create_tables, [Atlas, FreeSpace, Thumbnail, ThumbnailScale, Picture, Spritesheet])
+
+    def get_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self.pool is None:
+            self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        return self.pool
+
+    def close(self):
+        self.ssl.flush_all()
+        writer.flush()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    @staticmethod
+    @writer.writing
+    def get_picture(name, original_size: (int, int), fingerprint=None, stat=None) -> Picture:
+        """
+        Get the database row of an image, creating it or updating what changed.
+        'stat' is the (mtime, size) pair of the file the thumbnail is made from.
+        """
+        fields = dict(width=original_size[0], height=original_size[1], fingerprint=fingerprint,
+                      mtime=stat[0] if stat else None, file_size=stat[1] if stat else None)
+        picture = Picture.get_or_none(name=repr(name))
+        if picture is None:
+            return Picture.create(name=repr(name), **fields)
+        changed = {k: v for k, v in fields.items() if v is not None and getattr(picture, k) != v}
+        if changed:
+            Picture.update(**changed).where(Picture.id == picture.id).execute()
+            for k, v in changed.items():
+                setattr(picture, k, v)
+        return picture
+
+    def store(self, name, original_size: (int, int), image: pygame.Surface,
+              thumbnail_scale: ThumbnailScale, fingerprint=None, duplicates=(), stat=None) -> pygame.Surface:
+        """
+        Pack an already scaled thumbnail into a spritesheet and record it in the database.
+        The files named in 'duplicates' have the same content, and share the thumbnail's cell.
+        'stat' is the (mtime, size) of the file, taken before it was read.
+        """
+        pictures = {name: self.get_picture(name, original_size, fingerprint, stat)}
+        for i in duplicates:
+            pictures[i] = self.get_picture(i, original_size, fingerprint, self.fs.get_stat(i))
+
+        with self.pack_lock:
+            l.debug('Packing image into spritesheets...')
+            packer, spritesheet, rect = self.pack(image.get_rect(), thumbnail_scale)
+            l.debug(f'Packed image into  {spritesheet} at {rect}')
+
+            with self.ssl.lock:
+                sheet = self.ssl[spritesheet]
+                if sheet is None:
+                    sheet = pygame.Surface((spritesheet.width, spritesheet.height))
+
+                sheet.blit(image, rect)
+                with self.pending_lock:
+                    for i, picture in pictures.items():
+                        key = (repr(i), thumbnail_scale.id)
+                        self.pending[key] = dict(picture=picture, spritesheet=spritesheet, scale=thumbnail_scale,
+                                                 x=rect.left, y=rect.top, width=rect.width, height=rect.height)
+                        self.pending_sheets.setdefault(str(spritesheet), (packer, spritesheet, []))[2].append(key)
+                self.ssl.mark_dirty(spritesheet, sheet)
+        return image
+
+    def sheet_flushed(self, key: str):
+        """
+        Record the thumbnails of a sheet that has just been saved.
+        Until they are committed, they are only served from memory,
+        so the database never points at pixels that were not written.
+        """
+        with self.pending_lock:
+            packer, spritesheet, names = self.pending_sheets.pop(key, (None, None, []))
+            rows = [self.pending[i] for i in names]
+        if packer is None:
+            return
+
+        def insert():
+            for chunk in peewee.chunked(rows, 100):
+                Thumbnail.insert_many(chunk).on_conflict_replace().execute()
+            packer.persist(spritesheet)
 
-    def get_thumbnail(self, name, size: (int, int)) -> pygame.Surface:
+        writer.submit(insert).add_done_callback(lambda future: self.thumbnails_written(future, names))
+
+    def thumbnails_written(self, future: concurrent.futures.Future, names: [(str, int)]):
+        """Called on the writer thread once the thumbnails of a sheet are committed, or could not be."""
+        if future.exception() is not None:
+            l.error('Could not record the thumbnails of a spritesheet, they stay in memory only: %s',
+                    future.exception())
+            return
+        with self.pending_lock:
+            rows = [self.pending.pop(i, None) for i in names]
+        for row in rows:
+            if row is not None:
+                self.index_thumbnail(row)
+
+    def index_thumbnail(self, row: dict):
+        """Add a thumbnail that was just written to the database to the location index, if there is one."""
+        if self.locations is None:
+            return
+        picture = row['picture']
+        sheet = row['spritesheet']
+        sheet_id = sheet.id if isinstance(sheet, Spritesheet) else sheet
+        self.locations.add_picture(picture.name, picture.id)
+        self.locations.add(picture.id, row['scale'].id, sheet_id, row['x'], row['y'], row['width'], row['height'])
+
+    def lookup_many(self, names, thumbnail_scale: ThumbnailScale) -> {object: (int, pygame.Rect)}:
+        """
+        Find where the thumbnails of many images at one scale are, as (spritesheet id, rect).
+        Images without a thumbnail at this scale are left out. This is one indexed query per 500 images.
+        """
+        by_repr = {repr(i): i for i in names}
+        locations = dict()
+        with self.pending_lock:
+            for i in by_repr:
+                row = self.pending.get((i, thumbnail_scale.id))
+                if row is not None:
+                    locations[by_repr[i]] = (row['spritesheet'].id,
+                                             pygame.Rect(row['x'], row['y'], row['width'], row['height']))
+        stored = [i for i in by_repr if by_repr[i] not in locations]
+        if self.locations is not None:
+            for i in stored:
+                location = self.locations.find(self.locations.picture_id(i), thumbnail_scale.id)
+                if location is not None:
+                    locations[by_repr[i]] = location
+            return locations
+        for chunk in peewee.chunked(stored, 500):
+            for name, sheet_id, x, y, width, height in Thumbnail.select(
+                    Picture.name, Thumbnail.spritesheet, Thumbnail.x, Thumbnail.y, Thumbnail.width,
+                    Thumbnail.height).join(Picture).where(Picture.name.in_(chunk),
+                                                          Thumbnail.scale == thumbnail_scale).tuples():
+                locations[by_repr[name]] = (sheet_id, pygame.Rect(x, y, width, height))
+        return locations
+
+    def read_thumbnail(self, sheet_id: int, area: pygame.Rect, copy=True):
+        """Cut a thumbnail found by lookup_many() out of its spritesheet. Returns None if the sheet is broken."""
+        thumb = self.ssl.get_area(sheet_id, area, copy)
+        if thumb is None:
+            l.error('Spritesheet error! Discarding all data from this spritesheet and trying again.')
+            spritesheet = Spritesheet.get_or_none(id=sheet_id)
+            if self.locations is not None:
+                self.locations.remove_sheet(sheet_id)
+            if spritesheet is not None:
+                self.packer.forget(spritesheet)
+                if self.atlas_packer is not None:
+                    self.atlas_packer.forget(spritesheet)
+                writer.run(spritesheet.delete_instance, recursive=True)
+        return thumb
+
+    def find_thumbnail(self, name, thumbnail_scale: ThumbnailScale, copy=True):
+        """
+        Return the stored thumbnail of this image at this scale, or None if there is none yet.
+        If 'copy' is False, the thumbnail may be a read-only view into its spritesheet.
+        """
+        location = self.lookup_many([name], thumbnail_scale).get(name)
+        if location is None:
+            l.debug('No thumbnail of this image found at this size.')
+            return None
+        return self.read_thumbnail(*location, copy)
+
+    def find_duplicate(self, name, thumbnail_scale: ThumbnailScale, copy=True, fingerprint=None, stat=None):
+        """
+        Look for a stored thumbnail of another file with the same content, such as a copy or this file before it
+        was moved. If there is one, this file shares its cell. Returns the thumbnail or None, and the fingerprint.
+        The fingerprint and stat of the file are taken now if they are not given.
+        """
+        if fingerprint is None:
+            fingerprint = self.fs.get_fingerprint(name)
+        if fingerprint is None:
+            return None, None
+        with self.pending_lock:  # thumbnails that are not committed yet are not in the database
+            row = next((row for (_, scale_id), row in self.pending.items()
+                        if scale_id == thumbnail_scale.id and row['picture'].fingerprint == fingerprint), None)
+        if row is None:
+            source = (Thumbnail.select(Thumbnail, Picture).join(Picture)
+                      .where(Picture.fingerprint == fingerprint, Thumbnail.scale == thumbnail_scale).first())
+            if source is None:
+                return None, fingerprint
+            row = dict(picture=source.picture, spritesheet=source.spritesheet_id, scale=thumbnail_scale,
+                       x=source.x, y=source.y, width=source.width, height=source.height)
+        l.debug('%s has the same content as %s, sharing its thumbnail.', name, row['picture'].name)
+        self.share_cell(name, row, stat if stat is not None else self.fs.get_stat(name))
+        area = pygame.Rect(row['x'], row['y'], row['width'], row['height'])
+        return self.ssl.get_area(row['spritesheet'], area, copy), fingerprint
+
+    def share_cell(self, name, row: dict, stat=None):
+        """Give an image the cell of the thumbnail in 'row', which was made from a file with the same content."""
+        source = row['picture']
+        picture = self.get_picture(name, (source.width, source.height), source.fingerprint, stat)
+        row = dict(row, picture=picture)
+        key = (repr(name), row['scale'].id)
+        with self.pending_lock:
+            pending = self.pending_sheets.get(str(row['spritesheet']))
+            if pending is not None:  # recorded with the rest of its sheet once that is saved
+                self.pending[key] = row
+                pending[2].append(key)
+                return
+        writer.run(Thumbnail.create, **row)
+        self.index_thumbnail(row)
+
+    def find_larger(self, names, thumbnail_scale: ThumbnailScale) -> {object: tuple}:
+        """
+        Find the smallest stored thumbnail of each image that is at least as large as its thumbnail at this scale,
+        so that thumbnail can be made by downscaling it, like the next level of a mipmap, instead of decoding the file.
+        Returns (picture, spritesheet id, rect, size of the new thumbnail) for the images that have one.
+        """
+        by_repr = {repr(i): i for i in names}
+        candidates = collections.defaultdict(list)
+        with self.pending_lock:
+            for (name, scale_id), row in self.pending.items():
+                if name in by_repr and scale_id != thumbnail_scale.id:
+                    candidates[name].append((row['picture'], row['spritesheet'].id,
+                                             pygame.Rect(row['x'], row['y'], row['width'], row['height'])))
+        for chunk in peewee.chunked(by_repr, 500):
+            for t in Thumbnail.select(Thumbnail, Picture).join(Picture) \
+                    .where(Picture.name.in_(chunk), Thumbnail.scale != thumbnail_scale):
+                candidates[t.picture.name].append((t.picture, t.spritesheet_id,
+                                                   pygame.Rect(t.x, t.y, t.width, t.height)))
+        sources = dict()
+        scale_rect = pygame.Rect(0, 0, thumbnail_scale.width, thumbnail_scale.height)
+        for name, found in candidates.items():
+            picture = found[0][0]
+            size = pygame.Rect(0, 0, picture.width, picture.height).fit(scale_rect).size
+            large_enough = [(sheet_id, rect) for _, sheet_id, rect in found
+                            if rect.width >= size[0] and rect.height >= size[1]]
+            if large_enough:
+                sheet_id, rect = min(large_enough, key=lambda i: i[1].width * i[1].height)
+                sources[by_repr[name]] = (picture, sheet_id, rect, size)
+        return sources
+
+    def derive(self, name, source: tuple, thumbnail_scale: ThumbnailScale) -> pygame.Surface:
+        """Make and store the thumbnail of an image from a larger one found by find_larger()."""
+        picture, sheet_id, rect, size = source
+        larger = self.ssl.get_area(sheet_id, rect)
+        if larger is None:
+            return None
+        l.debug('Making the thumbnail of %s from its %dx%d one.', name, rect.width, rect.height)
+        image = pygame.transform.smoothscale(larger, size)
+        # The larger thumbnail was made from the file as it was then, so it keeps that file's stat.
+        stat = (picture.mtime, picture.file_size) if picture.mtime is not None else None
+        return self.store(name, (picture.width, picture.height), image, thumbnail_scale, picture.fingerprint,
+                          stat=stat)
+
+    def get_thumbnail(self, name, size: (int, int), copy=True) -> pygame.Surface:
+        """
+        Get the thumbnail of an image, making it if needed.
+
+        With copy=False, a stored thumbnail is returned as a view into its cached spritesheet instead of a new
+        surface. This saves an allocation and a blit for callers that only read the pixels;
+        callers that draw on the result must use the default copy.
+        Returns None if the image cannot be read, and a placeholder that is not stored if it is too large to decode.
+        """
         xsep = 'x'.join([str(i) for i in size])
-        thumbnail_scale, _ = ThumbnailScale.get_or_create(width=size[0], height=size[1])
+        thumbnail_scale = self.get_scale(size)
         l.debug('Getting thumbnail of %s at %s', name, xsep)
         if repr(name) in self.cache.get(xsep, dict()):
             l.debug('This file is in immediate cache.')
             return self.cache[xsep][repr(name)]
 
-        def get_new():
-            l.debug('This image not in spritesheet cache, get from filesystem.')
-            image = self.fs.get_image(name)
-            picture = Picture.create(name=repr(name), width=image.get_width(), height=image.get_height())
-            image = pygame.transform.scale(image, image.get_rect().fit(pygame.Rect((0, 0), size)).size)
+        thumb = self.find_thumbnail(name, thumbnail_scale, copy)
+        if thumb is not None:
+            return thumb
+        source = self.find_larger([name], thumbnail_scale).get(name)
+        if source is not None:
+            thumb = self.derive(name, source, thumbnail_scale)
+            if thumb is not None:
+                return thumb
+        thumb, fingerprint = self.find_duplicate(name, thumbnail_scale, copy)
+        if thumb is not None:
+            return thumb
+        l.debug('This image not in spritesheet cache, get from filesystem.')
+        stat = self.fs.get_stat(name)
+        image, original_size = self.fs.get_image_for_thumbnail(name, size)
+        if image is None:
+            return placeholder(original_size, size)
+        return self.store(name, original_size, scale_to_fit(image, size), thumbnail_scale, fingerprint, stat=stat)
 
-            l.debug('Packing image into spritesheets...')
-            spritesheet, rect = self.packer.add_rect(image.get_rect())
-            l.debug(f'Packed image into  {spritesheet} at {rect}')
+    def get_thumbnails(self, names, size: (int, int), copy=True):
+        """
+        Get thumbnails of many images, yielding (name, surface) pairs in completion order.
 
-            sheet = self.ssl[spritesheet]
-            if sheet is None:
-                sheet = pygame.Surface((spritesheet.width, spritesheet.height))
-            self.packer.inform_new_sheet(spritesheet, sheet.get_rect())
+        Stored thumbnails are yielded first, then the ones made from larger stored thumbnails.
+        The rest are fingerprinted in the process pool first, and those that have the same content as a stored
+        thumbnail, or as another image of the batch, share its cell; only the others are decoded and scaled there,
+        each content once, while packing, blitting and database writes stay in this process, one at a time.
+        If an image cannot be read, its surface is None. A name that is given twice is yielded once.
+        An image that is too large to decode gets a placeholder, which is not stored, like in get_thumbnail().
+        Closing the iterator early cancels the work that has not started yet.
+        'copy' is the same as in get_thumbnail().
+        """
+        thumbnail_scale = self.get_scale(size)
+        names = list(dict.fromkeys(names))
+        locations = self.lookup_many(names, thumbnail_scale)
+        missing = []
+        for name in names:
+            thumb = self.read_thumbnail(*locations[name], copy) if name in locations else None
+            if thumb is not None:
+                yield name, thumb
+            else:
+                missing.append(name)
+        if not missing:
+            return
 
-            sheet.blit(image, rect)
-            self.ssl[spritesheet] = sheet
+        sources = self.find_larger(missing, thumbnail_scale)
+        undecided = []
+        for name in missing:
+            thumb = self.derive(name, sources[name], thumbnail_scale) if name in sources else None
+            if thumb is not None:
+                yield name, thumb
+            else:
+                undecided.append(name)
 
-            thumbnail = Thumbnail.create(picture=picture, spritesheet=spritesheet, scale=thumbnail_scale, x=rect.left,
-                                         y=rect.top, width=rect.width, height=rect.height)
+        pool = self.get_pool()
+        fingerprinting = {pool.submit(fingerprint_file, self.fs, name) for name in undecided}
+        decoding = dict()  # future: (fingerprint, stat)
+        same_content = dict()  # fingerprint: [(name, stat)] of the files waiting for the one that is decoded
+        try:
+            while fingerprinting or decoding:
+                done, _ = concurrent.futures.wait(fingerprinting | decoding.keys(),
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    if future in fingerprinting:
+                        fingerprinting.remove(future)
+                        name, fingerprint, stat = future.result()
+                        thumb, _ = self.find_duplicate(name, thumbnail_scale, copy, fingerprint, stat)
+                        if thumb is not None:
+                            yield name, thumb
+                        elif fingerprint in same_content:
+                            same_content[fingerprint].append((name, stat))
+                        else:
+                            if fingerprint is not None:
+                                same_content[fingerprint] = []
+                            decoding[pool.submit(decode_and_scale, self.fs, name, size)] = (fingerprint, stat)
+                        continue
+                    fingerprint, stat = decoding.pop(future)
+                    name, original_size, scaled_size, data = future.result()
+                    copies = same_content.pop(fingerprint, []) if fingerprint is not None else []
+                    if data is None:
+                        thumb = placeholder(original_size, size)
+                        yield name, thumb
+                        for i, _ in copies:
+                            yield i, thumb
+                        continue
+                    image = pygame.image.fromstring(data, scaled_size, 'RGB')
+                    yield name, self.store(name, original_size, image, thumbnail_scale, fingerprint, stat=stat)
+                    for i, i_stat in copies:
+                        yield i, self.find_duplicate(i, thumbnail_scale, copy, fingerprint, i_stat)[0]
+        finally:
+            for future in fingerprinting | decoding.keys():
+                future.cancel()
 
-            return image
+    def find_stale(self, names) -> [object]:
+        """
+        Return the images whose files changed since their thumbnails were made, going by modification time and size.
+        Images stored before these were recorded take the current values, and are assumed to be up to date.
+        """
+        stale = []
+        for chunk in peewee.chunked(names, 500):
+            by_repr = {repr(i): i for i in chunk}
+            pictures = Picture.select(Picture.id, Picture.name, Picture.mtime, Picture.file_size) \
+                .where(Picture.name.in_(list(by_repr)))
+            unknown = []
+            for picture in pictures:
+                stat = self.fs.get_stat(by_repr[picture.name])
+                if stat is None:
+                    continue
+                if picture.mtime is None:
+                    unknown.append((picture.id, stat))
+                elif (picture.mtime, picture.file_size) != tuple(stat):
+                    stale.append(by_repr[picture.name])
+            if unknown:
+                writer.submit(self.record_stats, unknown)
+        return stale
 
-        picture = Picture.get_or_none(name=repr(name))
-        if picture is None:
-            l.debug('This image has not been seen before.')
-            return get_new()
-        thumbnail = Thumbnail.get_or_none(Thumbnail.picture == picture, Thumbnail.scale == thumbnail_scale)
-        if thumbnail is None:
-            l.debug('No thumbnail of this image found at this size.')
-            return get_new()
-        spritesheet = thumbnail.spritesheet
-        l.debug('This file exists in a spritesheet.')
-        sheet = self.ssl[spritesheet]
-        if sheet is None:
-            l.error('Spritesheet error! Discarding all data from this spritesheet and trying again.')
-            spritesheet.delete_instance(recursive=True)
-            return self.get_thumbnail(name, size)
+    @staticmethod
+    def record_stats(stats: [(int, (int, int))]):
+        for picture_id, stat in stats:
+            Picture.update(mtime=stat[0], file_size=stat[1]).where(Picture.id == picture_id).execute()
 
-        area = pygame.Rect(thumbnail.x, thumbnail.y, thumbnail.width, thumbnail.height)
-        thumb = self.ssl.cut_out(sheet, area)
-        return thumb
+    def release(self, sheet_id: int, rect: pygame.Rect):
+        """Give the space of a thumbnail that is no longer used back to the packer of its spritesheet."""
+        if self.atlas_packer is not None and self.atlas_packer.release(sheet_id, rect):
+            return
+        if not self.packer.release(sheet_id, rect):
+            l.debug('Spritesheet %s is an atlas, but atlases are disabled; its cell stays used.', sheet_id)
+
+    def invalidate(self, names) -> {(int, int): [object]}:
+        """
+        Forget the thumbnails of these images, and free their space unless another file shares it.
+        Returns the images grouped by the sizes they had thumbnails at, so they can be made again.
+        """
+        by_repr = {repr(i): i for i in names}
+        with self.pending_lock:
+            waiting = any(key[0] in by_repr for key in self.pending)
+        if waiting:
+            self.ssl.flush_all()
+            writer.flush()
+        for thumbs in self.cache.values():
+            for i in by_repr:
+                thumbs.pop(i, None)
+        sizes = collections.defaultdict(list)
+        cells = set()
+        freed = []
+
+        def forget():
+            for chunk in peewee.chunked(by_repr, 500):
+                thumbnails = list(Thumbnail.select(Thumbnail, Picture.id, Picture.name, ThumbnailScale)
+                                  .join(Picture).switch(Thumbnail).join(ThumbnailScale)
+                                  .where(Picture.name.in_(chunk)))
+                Thumbnail.delete().where(Thumbnail.id.in_([t.id for t in thumbnails])).execute()
+                if self.locations is not None:
+                    self.locations.remove_pictures({t.picture_id for t in thumbnails})
+                for t in thumbnails:
+                    sizes[(t.scale.width, t.scale.height)].append(by_repr[t.picture.name])
+                    cells.add((t.spritesheet_id, t.x, t.y, t.width, t.height))
+            for sheet_id, x, y, width, height in cells:
+                if not Thumbnail.select().where(Thumbnail.spritesheet == sheet_id, Thumbnail.x == x,
+                                                Thumbnail.y == y).exists():
+                    freed.append((sheet_id, pygame.Rect(x, y, width, height)))
+
+        writer.run(forget)
+        # Not on the writer thread: packing waits for it while holding the lock of the packers.
+        with self.pack_lock:
+            for sheet_id, rect in freed:
+                self.release(sheet_id, rect)
+        return dict(sizes)
+
+    @staticmethod
+    def live_cells() -> {int: {(int, int, int, int): int}}:
+        """The areas used by thumbnails in every sheet, as (x, y, width, height), with their scale id."""
+        cells = collections.defaultdict(dict)
+        for sheet_id, scale_id, x, y, width, height in Thumbnail.select(
+                Thumbnail.spritesheet, Thumbnail.scale, Thumbnail.x, Thumbnail.y, Thumbnail.width,
+                Thumbnail.height).tuples():
+            cells[sheet_id][(x, y, width, height)] = scale_id
+        return cells
+
+    def fragmentation_report(self) -> dict:
+        """
+        Describe how well the spritesheets are used, to decide when compact() is worth running.
+
+        'sheets' has an entry per sheet with its size, the atlas scale if it is an atlas,
+        the number and area of its live thumbnails, its fill ratio and its fragmentation:
+        the part of its free area that is not in the largest free block.
+        'scales' has an entry per ThumbnailScale with the number of thumbnails and how many sheets they are spread over.
+        'groups' has an entry per group of sheets that compact() repacks together, the atlases of each scale
+        and the packed sheets, with how many sheets it has and how many compact() would leave.
+        """
+        self.ssl.flush_all()
+        writer.flush()
+        cells = self.live_cells()
+        atlases = {a.spritesheet_id: a.scale_id for a in Atlas.select()}
+        scale_names = {i.id: f'{i.width}x{i.height}' for i in ThumbnailScale.select()}
+        sheets = []
+        groups = collections.defaultdict(list)
+        for sheet in Spritesheet.select().order_by(Spritesheet.id):
+            groups[atlases.get(sheet.id)].append(sheet)
+            area = sheet.width * sheet.height
+            live = cells.get(sheet.id, dict())
+            used = sum(w * h for x, y, w, h in live)
+            if sheet.id in atlases:
+                scale = ThumbnailScale.get_by_id(atlases[sheet.id])
+                grid = GridAtlas(scale.width, scale.height, sheet.width // scale.width, sheet.height // scale.height)
+                indexes = {grid.cell_index(x, y) for x, y, w, h in live}
+                free = grid.cells - len(indexes)
+                # Free cells after the last used one form one block; the others are holes.
+                holes = max(indexes, default=-1) + 1 - len(indexes)
+                fragmentation = holes / free if free else 0.0
+            else:
+                free_map = MaxRectsBin(sheet.width, sheet.height)
+                for rect in live:
+                    free_map.occupy(pygame.Rect(rect))
+                free = area - used
+                largest = max((r.width * r.height for r in free_map.free_rects), default=0)
+                fragmentation = 1 - largest / free if free else 0.0
+            sheets.append({'id': sheet.id, 'width': sheet.width, 'height': sheet.height,
+                           'atlas': scale_names.get(atlases.get(sheet.id)), 'thumbnails': len(live),
+                           'used_area': used, 'fill': used / area, 'fragmentation': fragmentation})
+
+        scales = dict()
+        for sheet_id, live in cells.items():
+            for (x, y, w, h), scale_id in live.items():
+                entry = scales.setdefault(scale_names[scale_id], {'thumbnails': 0, 'area': 0, 'sheets': set()})
+                entry['thumbnails'] += 1
+                entry['area'] += w * h
+                entry['sheets'].add(sheet_id)
+        for entry in scales.values():
+            entry['sheets'] = len(entry['sheets'])
+
+        group_report = []
+        for scale_id, group in groups.items():
+            new_maps, moves = self.plan_group(group, cells, None if scale_id is None
+                                              else ThumbnailScale.get_by_id(scale_id))
+            group_report.append({'atlas': scale_names.get(scale_id), 'thumbnails': len(moves), 'sheets': len(group),
+                                 'sheets_needed': min(len(new_maps), len(group))})
+        return {'sheets': sheets, 'scales': scales, 'groups': group_report}
+
+    def compact(self) -> int:
+        """
+        Repack the live thumbnails into as few spritesheets as possible. Returns how many sheets were freed.
+
+        Atlases are repacked into new atlases of their scale, and the other sheets together with MaxRects.
+        A group is only repacked if that takes fewer sheets. The new sheets are saved, then the database is switched
+        over to them in one transaction, and only then are the old sheets deleted.
+        Nothing else may use the manager while this runs.
+        """
+        with self.pack_lock, self.ssl.lock:
+            self.ssl.flush_all()
+            writer.flush()
+            self.cache.clear()
+            cells = self.live_cells()
+            atlases = {a.spritesheet_id: a.scale_id for a in Atlas.select()}
+            groups = collections.defaultdict(list)
+            for sheet in Spritesheet.select().order_by(Spritesheet.id):
+                groups[atlases.get(sheet.id)].append(sheet)
+            freed = 0
+            for scale_id, sheets in groups.items():
+                freed += self.compact_group(sheets, cells, None if scale_id is None
+                                            else ThumbnailScale.get_by_id(scale_id))
+            self.packer.reset()
+            if self.atlas_packer is not None:
+                self.atlas_packer.reset()
+            if self.locations is not None:
+                self.locations = LocationIndex.load()
+        l.info('Compaction freed %d spritesheets.', freed)
+        return freed
+
+    def compact_group(self, sheets: [Spritesheet], cells: dict, scale: ThumbnailScale = None) -> int:
+        """Repack the thumbnails of these sheets, which are all atlases of 'scale' or all packed sheets."""
+        new_maps, moves = self.plan_group(sheets, cells, scale)
+        if len(new_maps) >= len(sheets):
+            l.debug('Repacking %d sheets would not free any.', len(sheets))
+            return 0
+        l.info('Repacking %d thumbnails from %d sheets into %d.', len(moves), len(sheets), len(new_maps))
+        # If this is interrupted before the switch, the new sheets stay empty, and are filled by the packers later.
+        new_sheets = []
+        for index, new_map in enumerate(new_maps):
+            if scale is None:
+                width, height = new_map.width, new_map.height
+            else:
+                width, height = DEFAULT_WIDTH, DEFAULT_HEIGHT
+            new_sheet = writer.run(Spritesheet.create, width=width, height=height)
+            surface = pygame.Surface((width, height))
+            for _, sheet_id, rect, new_rect in sorted((i for i in moves if i[0] == index), key=lambda i: i[1]):
+                surface.blit(self.ssl.get_area(sheet_id, rect), new_rect)
+            self.ssl.save(str(new_sheet), surface)
+            self.ssl.touch(new_sheet)
+            new_sheets.append(new_sheet)
+
+        def switch():
+            for new_sheet, new_map in zip(new_sheets, new_maps):
+                if scale is None:
+                    FreeSpace.create(spritesheet=new_sheet, rects=new_map.dumps())
+                else:
+                    Atlas.create(spritesheet=new_sheet, scale=scale, columns=new_map.columns, rows=new_map.rows,
+                                 used=new_map.dumps())
+            for index, sheet_id, rect, new_rect in moves:
+                Thumbnail.update(spritesheet=new_sheets[index], x=new_rect.x, y=new_rect.y).where(
+                    Thumbnail.spritesheet == sheet_id, Thumbnail.x == rect.x, Thumbnail.y == rect.y).execute()
+            for sheet in sheets:
+                FreeSpace.delete().where(FreeSpace.spritesheet == sheet).execute()
+                Atlas.delete().where(Atlas.spritesheet == sheet).execute()
+                sheet.delete_instance()
+
+        writer.run(switch)
+        for sheet in sheets:
+            self.ssl.discard(sheet.id)
+        return len(sheets) - len(new_maps)
+
+    def plan_group(self, sheets: [Spritesheet], cells: dict, scale: ThumbnailScale = None):
+        """
+        Work out where compact_group() would put the thumbnails of these sheets, without moving anything.
+        Returns the free maps of the new sheets, and a (new sheet index, sheet id, rect, new rect) per thumbnail.
+        """
+        live = [(sheet.id, pygame.Rect(rect)) for sheet in sheets for rect in cells.get(sheet.id, ())]
+        live.sort(key=lambda i: (i[1].height, i[1].width), reverse=True)
+        new_maps = []
+        moves = []
+        for sheet_id, rect in live:
+            for index, new_map in enumerate(new_maps):
+                new_rect = self.place(new_map, rect)
+                if new_rect is not None:
+                    break
+            else:
+                if scale is None:
+                    new_map = MaxRectsBin(max(DEFAULT_WIDTH, rect.width), max(DEFAULT_HEIGHT, rect.height))
+                else:
+                    new_map = GridAtlas(scale.width, scale.height, DEFAULT_WIDTH // scale.width,
+                                        DEFAULT_HEIGHT // scale.height)
+                new_maps.append(new_map)
+                index = len(new_maps) - 1
+                new_rect = self.place(new_map, rect)
+            moves.append((index, sheet_id, rect, new_rect))
+        return new_maps, moves
+
+    @staticmethod
+    def place(free_map, rect: pygame.Rect):
+        """Place a rect into a new MaxRectsBin or GridAtlas, returning where it went or None if it is full."""
+        if isinstance(free_map, GridAtlas):
+            index = free_map.allocate()
+            return None if index is None else pygame.Rect(free_map.cell_rect(index).topleft, rect.size)
+        return free_map.insert(rect.width, rect.height)
+
+    def refresh_stale(self, names) -> [object]:
+        """Make the thumbnails of the images whose files changed again. Returns those images."""
+        stale = self.find_stale(names)
+        if not stale:
+            return []
+        l.info('%d thumbnails are out of date, making them again.', len(stale))
+        for size, group in self.invalidate(stale).items():
+            for _ in self.get_thumbnails(group, size):
+                pass
+        return stale
+
+
+def scale_to_fit(image: pygame.Surface, size: (int, int)) -> pygame.Surface:
+    return pygame.transform.scale(image, image.get_rect().fit(pygame.Rect((0, 0), size)).size)
+
+
+def placeholder(original_size: (int, int), size: (int, int)) -> pygame.Surface:
+    """
+    A grey surface that fits 'size', with the proportions of an image too large to decode, or None without its size.
+    It is never stored, so that the image is tried again, with the limit in effect then, the next time it is shown.
+    """
+    if original_size is None:
+        return None
+    rect = pygame.Rect((0, 0), original_size).fit(pygame.Rect((0, 0), size))
+    image = pygame.Surface((max(1, rect.width), max(1, rect.height)))
+    image.fill(PLACEHOLDER_COLOR)
+    return image
+
+
+def fingerprint_file(fs: abstract.FileSystemInterface, name):
+    """
+    Take the fingerprint and stat of an image without decoding it; this runs in a worker process.
+    The stat is taken before the file is decoded, by decode_and_scale().
+    """
+    try:
+        return name, fs.get_fingerprint(name), fs.get_stat(name)
+    except Exception:
+        l.info('Could not fingerprint image %s: %s', name, traceback.format_exc())
+        return name, None, None
+
+
+def decode_and_scale(fs: abstract.FileSystemInterface, name, size: (int, int)):
+    """
+    Load an image and scale it to fit the size; this runs in a worker process.
+    Surfaces cannot be pickled, so the pixels are returned as a string.
+    """
+    try:
+        image, original_size = fs.get_image_for_thumbnail(name, size)
+    except Exception:
+        l.info('Could not load image %s: %s', name, traceback.format_exc())
+        return name, None, None, None
+    if image is None:
+        return name, original_size, None, None
+    scaled = scale_to_fit(image, size)
+    return name, original_size, scaled.get_size(), pygame.image.tostring(scaled, 'RGB')
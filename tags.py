@@ -1,6 +1,10 @@
 #!/usr/bin/python3
+import threading
+
 import peewee
 
+import db_writer
+
 # tags.py - Store tags in a database.
 # Copyright (C) 2019 Danya Generalov (https://github.com/danya02)
 #
@@ -22,6 +26,9 @@ db = peewee.SqliteDatabase('./tags.sqlite', pragmas={
     'cache_size': -1024 * 1024})
 
 NULL='null tag'
+ANY = 'any'
+ALL = 'all'
+INSERT_CHUNK = 500  # stays below SQLite's limit on query parameters
 
 class BaseModel(peewee.Model):
     class Meta:
@@ -42,44 +49,142 @@ class Mapping(BaseModel):
 
 
 db.create_tables([Picture, Tag, Mapping])
+writer = db_writer.DatabaseWriter(db)
+
+
+def bit_positions(bits: int):
+    """Yield the positions of the set bits of an int, lowest first."""
+    reversed_binary = bin(bits)[:1:-1]
+    i = reversed_binary.find('1')
+    while i != -1:
+        yield i
+        i = reversed_binary.find('1', i + 1)
+
+
+def bits_from_positions(positions) -> int:
+    mask = bytearray()
+    for i in positions:
+        if i // 8 >= len(mask):
+            mask.extend(bytes(i // 8 + 1 - len(mask)))
+        mask[i // 8] |= 1 << (i % 8)
+    return int.from_bytes(mask, 'little')
+
+
+class TagIndex:
+    def __init__(self):
+        """
+        In-memory copy of the tag mappings.
+
+        Every tag has a bitset of the ids of its pictures, stored as an int, so filtering by many tags
+        is a few big-integer ANDs or ORs instead of a database query.
+        """
+        self.lock = threading.RLock()
+        self.bits: {str: int} = dict()
+        self.names: {int: str} = dict()
+
+    def load(self):
+        with self.lock:
+            positions = dict()
+            self.names = dict()
+            query = Mapping.select(Tag.name, Picture.id, Picture.name).join(Picture).switch(Mapping).join(Tag)
+            for tag, pic_id, pic_name in query.tuples().iterator():
+                positions.setdefault(tag, []).append(pic_id)
+                self.names[pic_id] = pic_name
+            self.bits = {tag: bits_from_positions(ids) for tag, ids in positions.items()}
+
+    def add(self, tag: str, pic_id: int, pic_name: str):
+        with self.lock:
+            self.names[pic_id] = pic_name
+            self.bits[tag] = self.bits.get(tag, 0) | (1 << pic_id)
+
+    def add_many(self, tag: str, pictures: [(int, str)]):
+        with self.lock:
+            self.names.update(pictures)
+            self.bits[tag] = self.bits.get(tag, 0) | bits_from_positions(i for i, _ in pictures)
+
+    def remove(self, tag: str, pic_id: int):
+        with self.lock:
+            if tag in self.bits:
+                self.bits[tag] &= ~(1 << pic_id)
+
+    def destroy(self, tag: str):
+        with self.lock:
+            self.bits.pop(tag, None)
+
+    def get_pictures(self, tags, mode=ANY) -> [str]:
+        with self.lock:
+            sets = [self.bits.get(i, 0) for i in set(tags)]
+            if not sets:
+                return []
+            result = sets[0]
+            for i in sets[1:]:
+                result = result & i if mode == ALL else result | i
+            return [self.names[i] for i in bit_positions(result)]
+
+
+index: TagIndex = None
+
+
+def enable_index() -> TagIndex:
+    """Load the in-memory tag index; from now on it is kept in sync and used for filtering."""
+    global index
+    new_index = TagIndex()
+    with new_index.lock:  # changes made while loading wait for the load to finish
+        index = new_index
+        new_index.load()
+    return new_index
 
 
 def get_all_tags():
     return [i.name for i in Tag.select()]
 
 
+@writer.writing
 def new_picture(name):
     with db.atomic():
         pic, created = Picture.get_or_create(name=name)
         if created:
             null_tag, _ = Tag.get_or_create(name=NULL)
             Mapping.create(picture=pic, tag=null_tag)
-        return pic
+    if created and index is not None:
+        index.add(NULL, pic.id, name)
+    return pic
 
-def add_many_pictures(list, callback):
-    list=list[:]
+@writer.writing
+def add_many_pictures(names, callback=None):
+    """
+    Add the pictures that are not in the database yet, with the null tag, and return their names.
+    Only these names are looked up, through the unique index on names, so adding a batch costs the same
+    however many pictures are already stored.
+    Progress is reported by calling callback(done, total), if it is given.
+    """
+    callback = callback or (lambda done, total: None)
+    names = list(dict.fromkeys(names))
     c=0
-    m=len(list)*2
-    callback(c,m)
-    if Picture.select().count==len(list):
-        return
-    for i in Picture.select():
-        c+=1
-        callback(c, m)
-        if i.name in list:
-            list.remove(i.name)
-    c=m//2
+    m=len(names)
     callback(c,m)
-    null_tag, _ = Tag.get_or_create(name=NULL)
+    new = []
+    null_tag = None
     with db.atomic():
-        for i in list:
-            pic=Picture.create(name=i)
-            Mapping.create(picture=pic,tag=null_tag)
+        for chunk in peewee.chunked(names, INSERT_CHUNK):
+            existing = {name for name, in Picture.select(Picture.name).where(Picture.name.in_(chunk)).tuples()}
+            fresh = [i for i in chunk if i not in existing]
+            if fresh:
+                if null_tag is None:
+                    null_tag, _ = Tag.get_or_create(name=NULL)
+                Picture.insert_many([(i,) for i in fresh], fields=[Picture.name]).execute()
+                Mapping.insert_from(Picture.select(Picture.id, peewee.Value(null_tag.id))
+                                    .where(Picture.name.in_(fresh)), [Mapping.picture, Mapping.tag]).execute()
+                if index is not None:
+                    index.add_many(NULL, list(Picture.select(Picture.id, Picture.name)
+                                              .where(Picture.name.in_(fresh)).tuples()))
+                new.extend(fresh)
+            c+=len(chunk)
             callback(c,m)
-            c+=1
-
+    return new
 
 
+@writer.writing
 def assign_tag(pic_name, tag_name):
     with db.atomic():
         pic, _ = Picture.get_or_create(name=pic_name)
@@ -90,8 +195,12 @@ def assign_tag(pic_name, tag_name):
         if null_map is not None:
             null_map.delete_instance()
         Mapping.get_or_create(picture=pic, tag=tag)
+    if index is not None:
+        index.remove(NULL, pic.id)
+        index.add(tag_name, pic.id, pic_name)
 
 
+@writer.writing
 def remove_tag(pic_name, tag_name):
     with db.atomic():
         pic, _ = Picture.get_or_create(name=pic_name)
@@ -99,31 +208,53 @@ def remove_tag(pic_name, tag_name):
         mapping = Mapping.get_or_none(tag=tag, picture=pic)
         if mapping is not None:
             mapping.delete_instance()
-        if Mapping.select().where(Mapping.picture==pic).count() == 0:
+        orphaned = Mapping.select().where(Mapping.picture==pic).count() == 0
+        if orphaned:
             null_tag, _ = Tag.get_or_create(name=NULL)
             Mapping.create(tag=null_tag, picture=pic)
+    if index is not None:
+        index.remove(tag_name, pic.id)
+        if orphaned:
+            index.add(NULL, pic.id, pic_name)
 
 
+@writer.writing
 def create_tag(tag):
     Tag.create(name=tag)
 
 
+@writer.writing
 def destroy_tag(tag):
     tag = Tag.get_or_none(name=tag)
     null_tag, _ = Tag.get_or_create(name=NULL)
     if tag is not None:
+        orphaned = []
         with db.atomic():
             for i in tag.mappings:
                 if i.picture.mappings.count()==1:
                     Mapping.create(picture=i.picture, tag=null_tag)
+                    orphaned.append((i.picture.id, i.picture.name))
                 i.delete_instance()
             tag.delete_instance()
+        if index is not None:
+            index.destroy(tag.name)
+            index.add_many(NULL, orphaned)
 
-def get_pictures_by_tags(tags):
-    tag_objs = [Tag.get(Tag.name == i) for i in tags]
-    mappings = list(Mapping.select(Mapping.picture).where(Mapping.tag << tag_objs))
-    pictures = [i.picture.name for i in mappings]
-    return pictures
+def get_pictures_by_tags(tags, mode=ANY):
+    """
+    Get the names of the pictures that have any of these tags, or all of them if mode is ALL.
+    Every name is returned once, in the order the pictures were added.
+    """
+    if index is not None:
+        return index.get_pictures(tags, mode)
+    tags = set(tags)
+    if not tags:
+        return []
+    query = (Picture.select(Picture.name).join(Mapping).join(Tag).where(Tag.name.in_(tags))
+             .group_by(Picture.id).order_by(Picture.id))
+    if mode == ALL:
+        query = query.having(peewee.fn.COUNT(Mapping.tag.distinct()) == len(tags))
+    return [name for name, in query.tuples()]
 
 def get_tags_of_picture(name):
     picture = new_picture(name)
@@ -0,0 +1,324 @@
+#!/usr/bin/python3
+import asyncio
+import concurrent.futures
+import logging
+import os
+import queue
+import threading
+import traceback
+
+import pygame
+
+import spritesheet_manager
+
+l = logging.getLogger(__name__)
+
+# thumbnail_pipeline.py - Make thumbnails in overlapping stages with asyncio, for slow file systems.
+# Copyright (C) 2019 Danya Generalov (https://github.com/danya02)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+DEFAULT_FETCHERS = 16
+DEFAULT_QUEUE_SIZE = 32
+DEFAULT_MAX_FETCHED_BYTES = 128 * 1024 * 1024
+
+
+class Item:
+    def __init__(self, name):
+        """One image going through the pipeline, with what the stages found out about it so far."""
+        self.names = [name]  # the first one is read, the others have the same content
+        self.source = None  # a larger stored thumbnail to make this one from
+        self.fingerprint = None
+        self.stat = None
+        self.data = None
+        self.reserved = 0  # bytes of the fetch budget taken by 'data'
+        self.image: pygame.Surface = None
+        self.original_size = None
+
+
+class ThumbnailPipeline:
+    def __init__(self, manager: spritesheet_manager.SpritesheetManager, size: (int, int),
+                 fetchers=DEFAULT_FETCHERS, decoders=None, queue_size=DEFAULT_QUEUE_SIZE,
+                 max_fetched_bytes=DEFAULT_MAX_FETCHED_BYTES, copy=True):
+        """
+        Makes the thumbnails of many images in four stages that run at the same time:
+        fetch reads the files, decode turns them into surfaces, scale shrinks those, and pack stores them.
+
+        On a file system with a lot of latency, fetching is what takes time, so up to 'fetchers' fetches
+        are in flight at once on threads. Decoding and scaling use at most 'decoders' threads each,
+        one per CPU by default, and packing is done one image at a time, like in SpritesheetManager.
+        The stages are connected by queues that hold at most 'queue_size' images,
+        so a slow stage, or a slow consumer of the results, holds back the stages before it.
+        The files that are read and not decoded yet take at most 'max_fetched_bytes' between them,
+        except for a single file that is larger than that; it is read when nothing else is held.
+
+        Thumbnails that are already stored, or can be made from a larger stored one or from a file
+        with the same content, skip the stages they do not need.
+        'copy' is the same as in SpritesheetManager.get_thumbnail().
+        """
+        self.manager = manager
+        self.fs = manager.fs
+        self.size = tuple(size)
+        self.fetchers = fetchers
+        self.decoders = decoders or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.max_fetched_bytes = max_fetched_bytes
+        self.fetched_bytes = 0
+        self.fetched_changed: asyncio.Condition = None
+        self.copy = copy
+        self.cancelled = set()
+        self.same_content: {str: Item} = dict()
+        self.loop = None
+        self.pools = dict()
+        self.queues = dict()
+        self.results: asyncio.Queue = None
+        self.total = 0
+        self.done = 0
+        self.thumbnail_scale = None
+
+    def cancel(self, name):
+        """
+        Stop working on an image; it is dropped at the start of the next stage, and never yielded.
+        This can be called from any thread.
+        """
+        self.cancelled.add(name)
+
+    def is_cancelled(self, item: Item):
+        return all(i in self.cancelled for i in item.names)
+
+    async def run(self, names):
+        """
+        Make the thumbnails of these images, yielding (name, surface) pairs in completion order.
+        If an image cannot be read, its surface is None. Every name is yielded once, unless it is cancelled.
+        Closing the generator early stops the pipeline.
+        """
+        names = [i for i in dict.fromkeys(names) if i not in self.cancelled]
+        if not names:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.total = len(names)
+        self.done = 0
+        self.fetched_bytes = 0
+        self.fetched_changed = asyncio.Condition()
+        self.same_content = dict()
+        self.queues = {i: asyncio.Queue(self.queue_size) for i in ('fetch', 'decode', 'scale', 'pack')}
+        self.results = asyncio.Queue(self.queue_size)
+        self.pools = {
+            'fetch': concurrent.futures.ThreadPoolExecutor(self.fetchers, thread_name_prefix='fetch'),
+            'decode': concurrent.futures.ThreadPoolExecutor(self.decoders, thread_name_prefix='decode'),
+            'scale': concurrent.futures.ThreadPoolExecutor(self.decoders, thread_name_prefix='scale'),
+            'pack': concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='pack')}
+        self.thumbnail_scale = await self.in_thread('fetch', self.manager.get_scale, self.size)
+        workers = [self.feed(names)]
+        workers += [self.work('fetch', self.fetch) for _ in range(self.fetchers)]
+        workers += [self.work('decode', self.decode) for _ in range(self.decoders)]
+        workers += [self.work('scale', self.scale) for _ in range(self.decoders)]
+        workers += [self.work('pack', self.pack)]
+        tasks = [self.loop.create_task(i) for i in workers]
+        try:
+            while True:
+                result = await self.results.get()
+                if result is None:
+                    return
+                yield result
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for pool in self.pools.values():
+                pool.shutdown(wait=False, cancel_futures=True)
+            # A store() that is still running must be done before the caller, or another pipeline, uses the manager.
+            await self.loop.run_in_executor(None, self.pools['pack'].shutdown)
+
+    def in_thread(self, stage, function, *args):
+        return self.loop.run_in_executor(self.pools[stage], function, *args)
+
+    async def finish(self, count=1):
+        self.done += count
+        if self.done == self.total:
+            await self.results.put(None)
+
+    async def reserve(self, item: Item, amount):
+        """Wait until 'amount' bytes of the fetch budget are free, and take them for an item."""
+        async with self.fetched_changed:
+            await self.fetched_changed.wait_for(
+                lambda: self.fetched_bytes == 0 or self.fetched_bytes + amount <= self.max_fetched_bytes)
+            self.fetched_bytes += amount
+            item.reserved = amount
+
+    async def release(self, item: Item, keep=0):
+        """Give back the fetch budget of an item, except for 'keep' bytes."""
+        if item.reserved == keep:
+            return
+        async with self.fetched_changed:
+            self.fetched_bytes += keep - item.reserved
+            item.reserved = keep
+            self.fetched_changed.notify_all()
+
+    async def emit(self, item: Item, thumb):
+        item.data = None
+        await self.release(item)
+        if self.same_content.get(item.fingerprint) is item:
+            del self.same_content[item.fingerprint]
+        for name in item.names:
+            if name not in self.cancelled:
+                await self.results.put((name, thumb))
+            await self.finish()
+
+    async def feed(self, names):
+        """Yield what is already stored, and send the rest to the stage that makes them."""
+        for start in range(0, len(names), self.queue_size):
+            chunk = names[start:start + self.queue_size]
+            try:
+                locations = await self.in_thread('fetch', self.manager.lookup_many, chunk, self.thumbnail_scale)
+                sources = await self.in_thread('fetch', self.manager.find_larger,
+                                               [i for i in chunk if i not in locations], self.thumbnail_scale)
+            except Exception:
+                l.error('Could not look up stored thumbnails: %s', traceback.format_exc())
+                locations, sources = dict(), dict()
+            for name in chunk:
+                item = Item(name)
+                if self.is_cancelled(item):
+                    await self.finish()
+                    continue
+                if name in locations:
+                    thumb = await self.in_thread('fetch', self.manager.read_thumbnail, *locations[name], self.copy)
+                    if thumb is not None:
+                        await self.emit(item, thumb)
+                        continue
+                if name in sources:
+                    item.source = sources[name]
+                    await self.queues['pack'].put(item)
+                else:
+                    await self.queues['fetch'].put(item)
+
+    async def work(self, stage, step):
+        """Run one worker of a stage: take images from its queue and do 'step' on each."""
+        inbox = self.queues[stage]
+        while True:
+            item = await inbox.get()
+            try:
+                if self.is_cancelled(item):
+                    l.debug('Dropping cancelled %s before %s.', item.names[0], stage)
+                    await self.emit(item, None)
+                else:
+                    await step(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                l.error('Could not %s %s: %s', stage, item.names[0], traceback.format_exc())
+                await self.emit(item, None)
+
+    async def fetch(self, item: Item):
+        name = item.names[0]
+        thumb, item.fingerprint = await self.in_thread('fetch', self.manager.find_duplicate, name,
+                                                       self.thumbnail_scale, self.copy)
+        if thumb is not None:
+            await self.emit(item, thumb)
+            return
+        if item.fingerprint is not None:
+            first = self.same_content.get(item.fingerprint)
+            if first is not None:
+                l.debug('%s has the same content as %s, which is already being read.', name, first.names[0])
+                first.names.append(name)
+                return
+            self.same_content[item.fingerprint] = item
+        item.stat = await self.in_thread('fetch', self.fs.get_stat, name)
+        # How much of the file is read is only known afterwards, so the whole file is reserved until then.
+        await self.reserve(item, item.stat[1] if item.stat is not None else 0)
+        item.data = await self.in_thread('fetch', self.fs.fetch, name, self.size)
+        await self.release(item, len(item.data) if item.data is not None else 0)
+        await self.queues['decode'].put(item)
+
+    async def decode(self, item: Item):
+        data, item.data = item.data, None
+        item.image, item.original_size = await self.in_thread('decode', self.fs.decode_fetched, item.names[0],
+                                                              data, self.size)
+        del data
+        await self.release(item)
+        if item.image is None:
+            await self.emit(item, spritesheet_manager.placeholder(item.original_size, self.size))
+        else:
+            await self.queues['scale'].put(item)
+
+    async def scale(self, item: Item):
+        item.image = await self.in_thread('scale', spritesheet_manager.scale_to_fit, item.image, self.size)
+        await self.queues['pack'].put(item)
+
+    async def pack(self, item: Item):
+        if item.source is not None:
+            thumb = await self.in_thread('pack', self.manager.derive, item.names[0], item.source,
+                                         self.thumbnail_scale)
+        else:
+            # Files with this content that are found from now on are read again, since the cell is being made.
+            if self.same_content.get(item.fingerprint) is item:
+                del self.same_content[item.fingerprint]
+            thumb = await self.in_thread('pack', self.manager.store, item.names[0], item.original_size, item.image,
+                                         self.thumbnail_scale, item.fingerprint, item.names[1:], item.stat)
+        await self.emit(item, thumb)
+
+
+def iterate(manager: spritesheet_manager.SpritesheetManager, names, size: (int, int), pipeline=None, **options):
+    """
+    Run a ThumbnailPipeline on an event loop in its own thread, and yield its results in this one,
+    for callers that are not asyncio code themselves, like the GTK interface.
+    'options' are passed to ThumbnailPipeline, or 'pipeline' is used if given, so that the caller can cancel images.
+    Closing the iterator stops the pipeline.
+    """
+    if pipeline is None:
+        pipeline = ThumbnailPipeline(manager, size, **options)
+    results = queue.Queue(pipeline.queue_size)
+    done = object()
+    loop = asyncio.new_event_loop()
+
+    async def consume():
+        generator = pipeline.run(names)
+        try:
+            async for result in generator:
+                await loop.run_in_executor(None, results.put, result)
+        finally:
+            await generator.aclose()
+
+    task = loop.create_task(consume())
+
+    def run():
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            l.error('Thumbnail pipeline failed: %s', traceback.format_exc())
+        finally:
+            loop.run_until_complete(loop.shutdown_default_executor())
+            loop.close()
+            results.put(done)
+
+    thread = threading.Thread(target=run, name='ThumbnailPipeline', daemon=True)
+    thread.start()
+    try:
+        while True:
+            result = results.get()
+            if result is done:
+                return
+            yield result
+    finally:
+        try:
+            loop.call_soon_threadsafe(task.cancel)
+        except RuntimeError:  # the loop is already closed
+            pass
+        while thread.is_alive():
+            try:
+                results.get(timeout=0.1)  # a result that is being handed over would block the loop's thread
+            except queue.Empty:
+                pass